@@ -0,0 +1,220 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# 熱點效能基準測試
+# 使用專案內附的 binary_CountryState_*.png 與 CountryState_Yiguo.png，量測二值化、各欄位 OCR、
+# getAllProperties 以及以本地替身 (Discord / Google Sheets) 執行的完整 main.main。
+# 結果 (平均、p95、每秒圖片數、峰值 RSS) 寫成 JSON，可用 --compare 與上一次的結果比較。
+#   python benchmark.py --iterations 20 --output bench.json --compare previous.json
+
+# main.main 的 OCR 快取寫在暫存目錄，不影響 .ocr_cache；執行報告不寫入 (必須在匯入 ocrCache / runMetrics 之前設定)
+_CACHE_DIR = tempfile.mkdtemp(prefix="ninesols-bench-")
+os.environ["OCR_CACHE_DIR"] = _CACHE_DIR
+os.environ["RUN_REPORT_FILE"] = os.devnull
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import countryInfoExtractor
+from countryInfoExtractor import (ENGINE_EASYOCR, ENGINE_TEMPLATE, FIELD_BOXES, OCR_USE_GPU, TEMPLATE_SAMPLE_LABELS,
+                                  getAllProperties, getCultureText, getMilitaryText, getTechText, getTradeText)
+from imagePreprocessor import binarize_any_channel, binarize_rois, preprocess_image
+from localStandIns import FakeWorksheet
+from ocrReader import get_reader, get_reader_load_seconds
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RAW_FIXTURE = os.path.join(BASE_DIR, "CountryState_Yiguo.png")
+BINARY_FIXTURES = sorted(glob.glob(os.path.join(BASE_DIR, "binary_CountryState_*.png")))
+DEFAULT_ITERATIONS = 10
+FIELD_FUNCTIONS = {
+    "Military": getMilitaryText,
+    "Trade": getTradeText,
+    "Tech": getTechText,
+    "Culture": getCultureText,
+}
+
+
+def peak_rss_mb():
+    """返回目前行程的峰值 RSS (MB)；Linux 的 ru_maxrss 單位是 KB，macOS 是 bytes。"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def measure(name, func, iterations, images_per_call=1, warmup=1):
+    """重複執行 func 並返回延遲統計 (毫秒) 與每秒處理的圖片數。"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples_np = np.array(samples)
+    mean_ms = float(samples_np.mean())
+    result = {
+        "name": name,
+        "iterations": iterations,
+        "mean_ms": round(mean_ms, 3),
+        "p95_ms": round(float(np.percentile(samples_np, 95)), 3),
+        "min_ms": round(float(samples_np.min()), 3),
+        "images_per_second": round(images_per_call * 1000 / mean_ms, 2) if mean_ms > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(f"  {name}: 平均 {result['mean_ms']:.2f} ms，p95 {result['p95_ms']:.2f} ms，"
+          f"{result['images_per_second']} 張/秒，峰值 RSS {result['peak_rss_mb']} MB")
+    return result
+
+def load_binary_fixtures():
+    """返回 {附件檔名: (圖片內容, 已二值化的 PIL Image)}，附件檔名與 Discord 上的相同。"""
+    fixtures = {}
+    for path in BINARY_FIXTURES:
+        attachment_filename = os.path.basename(path).removeprefix("binary_").removesuffix(".png")
+        with open(path, "rb") as f:
+            content = f.read()
+        fixtures[attachment_filename] = (content, Image.open(io.BytesIO(content)).convert("L"))
+    return fixtures
+
+def ocr_accuracy(fixtures, engine):
+    """以 TEMPLATE_SAMPLE_LABELS 的人工標記計算 getAllProperties 的欄位正確率。"""
+    correct = total = 0
+    for attachment_filename, (_, img) in fixtures.items():
+        labels = TEMPLATE_SAMPLE_LABELS.get(f"binary_{attachment_filename}.png")
+        if labels is None:
+            continue
+        properties = getAllProperties(img, engine)
+        for field, label in zip(FIELD_BOXES, labels):
+            correct += properties[field] == int(label)
+            total += 1
+    return round(correct / total, 4) if total else None
+
+
+# --- main.main 的本地替身 ---
+
+class FixtureImageSource:
+    """直接返回內附樣本的圖片來源 (介面與 selfBotExecutor.DiscordImageSource 相同)。"""
+
+    name = "fixtures"
+
+    def __init__(self, images):
+        self.images = images
+
+    def fetch(self):
+        return True, dict(self.images)
+
+
+def run_main_with_stand_ins(discord_images):
+    """以本地替身取代 Discord 與 Google Sheets 執行一次 main.main，輸出被丟棄。"""
+    import main
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.main(source=FixtureImageSource(discord_images), worksheet=FakeWorksheet())
+    finally:
+        countryInfoExtractor.use_roi_cache(None) # 不讓 main 的欄位快取影響之後的量測
+
+
+def clear_ocr_cache():
+    shutil.rmtree(_CACHE_DIR, ignore_errors=True)
+
+
+# --- 基準測試 ---
+
+def run_benchmarks(iterations, include_ocr=True, include_main=True):
+    results = []
+    with open(RAW_FIXTURE, "rb") as f:
+        raw_bytes = f.read()
+    fixtures = load_binary_fixtures()
+    sample_img = next(iter(fixtures.values()))[1]
+
+    print("--- 二值化 ---")
+    results.append(measure("preprocess_image", lambda: preprocess_image(Image.open(io.BytesIO(raw_bytes))), iterations))
+    results.append(measure("binarize_rois", lambda: binarize_rois(raw_bytes, FIELD_BOXES), iterations))
+    raw_cv = cv2.imread(RAW_FIXTURE)
+    results.append(measure("decode_png_cv2", lambda: cv2.imdecode(np.frombuffer(raw_bytes, np.uint8), cv2.IMREAD_COLOR), iterations))
+    results.append(measure("binarize_any_channel", lambda: binarize_any_channel(raw_cv), iterations))
+
+    print("--- 模板比對 ---")
+    for field, func in FIELD_FUNCTIONS.items():
+        results.append(measure(f"template.{field}", lambda func=func: func(sample_img, ENGINE_TEMPLATE), iterations))
+    results.append(measure("template.getAllProperties", lambda: getAllProperties(sample_img, ENGINE_TEMPLATE), iterations))
+
+    accuracy = {ENGINE_TEMPLATE: ocr_accuracy(fixtures, ENGINE_TEMPLATE)}
+    reader_load_seconds = None
+    if include_ocr:
+        print("--- EasyOCR ---")
+        get_reader(OCR_USE_GPU)
+        reader_load_seconds = get_reader_load_seconds(OCR_USE_GPU)
+        for field, func in FIELD_FUNCTIONS.items():
+            results.append(measure(f"easyocr.{field}", lambda func=func: func(sample_img, ENGINE_EASYOCR), iterations))
+        results.append(measure("easyocr.getAllProperties", lambda: getAllProperties(sample_img, ENGINE_EASYOCR), iterations))
+        accuracy[ENGINE_EASYOCR] = ocr_accuracy(fixtures, ENGINE_EASYOCR)
+
+    if include_main:
+        print("--- main.main (本地替身) ---")
+        discord_images = {filename: content for filename, (content, _) in fixtures.items()}
+        images = len(discord_images)
+
+        def cold_run():
+            clear_ocr_cache() # 每次都從空的 OCR 快取開始
+            run_main_with_stand_ins(discord_images)
+
+        results.append(measure("main.cold_cache", cold_run, max(1, iterations // 5), images_per_call=images))
+        cold_run() # 建立快取，之後的執行都命中
+        results.append(measure("main.warm_cache", lambda: run_main_with_stand_ins(discord_images),
+                               iterations, images_per_call=images))
+
+    return {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "reader_load_seconds": reader_load_seconds,
+        "ocr_accuracy": accuracy,
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results,
+    }
+
+def compare(report, previous_path):
+    """列出與上一次結果相比平均延遲的變化。"""
+    with open(previous_path, "r", encoding="utf-8") as f:
+        previous = {result["name"]: result for result in json.load(f)["results"]}
+    print(f"--- 與 {previous_path} 比較 (平均延遲) ---")
+    for result in report["results"]:
+        before = previous.get(result["name"])
+        if before is None or not before["mean_ms"]:
+            continue
+        change = (result["mean_ms"] - before["mean_ms"]) / before["mean_ms"] * 100
+        print(f"  {result['name']}: {before['mean_ms']:.2f} -> {result['mean_ms']:.2f} ms ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="效能基準測試")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--output", default="benchmark_results.json", help="結果 JSON 路徑")
+    parser.add_argument("--compare", help="要比較的上一次結果 JSON")
+    parser.add_argument("--skip-ocr", action="store_true", help="略過 EasyOCR 量測")
+    parser.add_argument("--skip-main", action="store_true", help="略過 main.main 量測")
+    args = parser.parse_args(argv)
+
+    try:
+        report = run_benchmarks(args.iterations, include_ocr=not args.skip_ocr, include_main=not args.skip_main)
+    finally:
+        clear_ocr_cache()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {args.output}，峰值 RSS {report['peak_rss_mb']} MB")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
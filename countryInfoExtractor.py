@@ -1,55 +1,326 @@
-import easyocr
+import functools
+import os
+
 import numpy as np
 from PIL import Image
 
-# 初始化 EasyOCR Reader (只需要執行一次)
-# 指定辨識英文 (包含數字)
+from ocrReader import get_reader, read_tiered
+from runMetrics import incr, span
+
+# EasyOCR Reader 由 ocrReader 延遲建立並在整個行程共用
 # gpu=False 可以強制使用 CPU，如果您的環境沒有 CUDA 或想避免 GPU 問題
-reader = easyocr.Reader(['en'], gpu=False) # 或者 gpu=True
+OCR_USE_GPU = False
+
+# 各屬性在 800x450 狀態圖上的固定裁切框 (左,上,右,下)
+FIELD_BOXES = {
+    "Military": (480, 159, 581, 200),
+    "Trade": (487, 225, 576, 264),
+    "Tech": (486, 286, 576, 325),
+    "Culture": (489, 349, 579, 386),
+}
+
+DIGIT_ALLOWLIST = '0123456789'
+
+# 批次辨識時，畫布上相鄰裁切區域之間的空白高度 (像素)
+BATCH_ROW_GAP = 8
+
+# 欄位裁切區域的指紋快取 (ocrCache.RoiFingerprintCache)，由 use_roi_cache 啟用
+_roi_cache = None
 
-def _extract_text_from_image(img_crop):
-    """使用 EasyOCR 從裁切後的圖片中提取文字。"""
+def use_roi_cache(cache):
+    """啟用 (或傳入 None 停用) 欄位指紋快取；像素完全相同的欄位不再送去辨識。"""
+    global _roi_cache
+    _roi_cache = cache
+
+def _parse_digits(text):
+    """將辨識結果轉為整數，失敗時返回原始字串。"""
+    text = text.strip()
     try:
-        # 將 PIL Image 轉換為 NumPy 陣列
-        img_np = np.array(img_crop)
+        return int(text)
+    except ValueError:
+        return text # 或者返回 None 或保持原樣
 
-        # 使用 EasyOCR 辨識文字，限制只辨識數字
-        # detail=0 只返回文字，更快； paragraph=False 處理單行
-        results = reader.readtext(img_np, allowlist='0123456789', detail=0, paragraph=False)
+def _extract_text_from_image(img_crop, field=None):
+    """使用 EasyOCR 從裁切後的圖片中提取文字 (分級辨識，見 ocrReader.read_tiered)。"""
+    try:
+        # 將 PIL Image 轉換為 NumPy 陣列 (已經是陣列時不複製)
+        img_np = np.asarray(img_crop)
 
-        # 合併所有辨識到的文字片段 (通常應該只有一個)
-        extracted_text = "".join(results).strip()
-        # 嘗試轉換為整數，如果失敗則返回原始字串或空字串
-        try:
-            return int(extracted_text)
-        except ValueError:
-            return extracted_text # 或者返回 None 或保持原樣
+        # 限制只辨識數字，並嘗試轉換為整數
+        text, _ = read_tiered(img_np, field, OCR_USE_GPU, allowlist=DIGIT_ALLOWLIST)
+        return _parse_digits(text)
     except Exception as e:
         print(f"EasyOCR 辨識時發生錯誤: {e}")
         return None # 返回 None 表示錯誤或未辨識
 
-def getMilitaryText(img):
-    militaryCrop = img.crop((480, 159, 581, 200))  # 左,上,右,下
-    return _extract_text_from_image(militaryCrop)
+# --- 模板比對數字辨識 (純 NumPy，不需要 torch) ---
+# 狀態圖上的數字都是遊戲以同一種字型繪製，因此可以用模板比對取代 EasyOCR
+ENGINE_EASYOCR = 'easyocr'
+ENGINE_TEMPLATE = 'template'
+
+DIGIT_TEMPLATES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'digit_templates.png')
+TEMPLATE_HEIGHT = 24 # 每個字元正規化後的高度
+TEMPLATE_WIDTH = 16 # 每個字元正規化後的寬度
+TEMPLATE_MIN_SCORE = 0.7 # 任一字元的相關係數低於此值時改用 EasyOCR
+MIN_GLYPH_HEIGHT = 8 # 高度低於此值的連通欄位視為雜訊
+
+# 用於建立模板庫的內建二值化樣本及其正確數值 (依 FIELD_BOXES 的順序)
+TEMPLATE_SAMPLE_LABELS = {
+    "binary_CountryState_Changuo.png.png": ("2569", "4192", "2629", "3420"),
+    "binary_CountryState_GuiFang.png.png": ("2185", "4374", "2382", "4219"),
+    "binary_CountryState_Shang.png.png": ("1359", "5676", "2091", "4293"),
+    "binary_CountryState_Xiaguo.png.png": ("2548", "3636", "3367", "3950"),
+    "binary_CountryState_Yan.png.png": ("2019", "3362", "3194", "3213"),
+    "binary_CountryState_Yiguo.png.png": ("2344", "4154", "2474", "4448"),
+    "binary_CountryState_Ying.png.png": ("2499", "4268", "4370", "4170"),
+    "binary_CountryState_Yumin.png.png": ("2141", "1701", "2473", "4273"),
+}
 
-def getTradeText(img):
-    tradeCrop = img.crop((487, 225, 576, 264))  # 左,上,右,下
-    return _extract_text_from_image(tradeCrop)
+_digit_templates = None # 延遲載入的模板矩陣，形狀為 (10, 高*寬)
 
-def getTechText(img):
-    techCrop = img.crop((486, 286, 576, 325))  # 左,上,右,下
-    return _extract_text_from_image(techCrop)
+def _segment_glyphs(binary_np, with_columns=False):
+    """以欄投影將二值化的裁切區域切割成字元，返回由左到右的布林陣列列表。
+
+    with_columns=True 時返回 (起始欄, 結束欄, 字元) 的列表 (localStandIns 用來計算字元間距)。
+    """
+    foreground = binary_np > 127
+    columns = np.concatenate(([False], foreground.any(axis=0), [False]))
+    edges = np.diff(columns.astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    glyphs = []
+    for start, end in zip(starts, ends):
+        glyph = foreground[:, start:end]
+        rows = np.flatnonzero(glyph.any(axis=1))
+        if rows[-1] - rows[0] + 1 < MIN_GLYPH_HEIGHT:
+            continue
+        glyph = glyph[rows[0]:rows[-1] + 1]
+        glyphs.append((start, end, glyph) if with_columns else glyph)
+    return glyphs
+
+@functools.lru_cache(maxsize=256)
+def _resample_index(h, w):
+    """最近鄰取樣用的列/欄索引 (字元尺寸種類很少，因此快取)。"""
+    row_idx = np.arange(TEMPLATE_HEIGHT) * h // TEMPLATE_HEIGHT
+    col_idx = np.arange(TEMPLATE_WIDTH) * w // TEMPLATE_WIDTH
+    return row_idx[:, None], col_idx
+
+def _resample_glyph(glyph):
+    """以最近鄰取樣將字元縮放到固定大小 (TEMPLATE_HEIGHT, TEMPLATE_WIDTH)。"""
+    return glyph[_resample_index(*glyph.shape)]
+
+def _normalize_rows(matrix):
+    """將每一列轉為零均值、單位長度，使內積即為相關係數。"""
+    matrix = matrix - matrix.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def build_digit_templates(sample_dir=None, output_path=DIGIT_TEMPLATES_FILE):
+    """由內建的二值化樣本平均出 0-9 的模板，並存成一張 (高, 10*寬) 的灰階圖片。"""
+    sample_dir = sample_dir or os.path.dirname(DIGIT_TEMPLATES_FILE)
+    sums = np.zeros((10, TEMPLATE_HEIGHT, TEMPLATE_WIDTH), dtype=np.float64)
+    counts = np.zeros(10, dtype=np.int64)
+    for filename, labels in TEMPLATE_SAMPLE_LABELS.items():
+        img = Image.open(os.path.join(sample_dir, filename)).convert('L')
+        for box, label in zip(FIELD_BOXES.values(), labels):
+            glyphs = _segment_glyphs(np.asarray(img.crop(box)))
+            if len(glyphs) != len(label):
+                raise ValueError(f"{filename} 的 {label} 切割出 {len(glyphs)} 個字元")
+            for glyph, digit in zip(glyphs, label):
+                sums[int(digit)] += _resample_glyph(glyph)
+                counts[int(digit)] += 1
+    if not counts.all():
+        raise ValueError(f"樣本中缺少數字: {np.flatnonzero(counts == 0).tolist()}")
+    means = sums / counts[:, None, None]
+    bank = np.hstack(list(np.round(means * 255).astype(np.uint8)))
+    Image.fromarray(bank).save(output_path)
+    return output_path
+
+def _load_digit_templates():
+    """載入模板庫 (只載入一次)，返回正規化後的 (10, 高*寬) 矩陣。"""
+    global _digit_templates
+    if _digit_templates is None:
+        bank = np.asarray(Image.open(DIGIT_TEMPLATES_FILE).convert('L'), dtype=np.float32)
+        templates = bank.reshape(TEMPLATE_HEIGHT, 10, TEMPLATE_WIDTH).transpose(1, 0, 2).reshape(10, -1)
+        _digit_templates = _normalize_rows(templates)
+    return _digit_templates
+
+def _match_digits(img_crop):
+    """以模板比對辨識裁切區域中的數字。
+
+    返回:
+        tuple: (數字字串, 最低相關係數)；無法切割出字元時返回 ("", 0.0)
+    """
+    glyphs = _segment_glyphs(np.asarray(img_crop))
+    if not glyphs:
+        return "", 0.0
+    vectors = _normalize_rows(np.stack([_resample_glyph(glyph).ravel() for glyph in glyphs]).astype(np.float32))
+    scores = vectors @ _load_digit_templates().T # (字元數, 10) 的相關係數
+    digits = scores.argmax(axis=1)
+    text = "".join(str(d) for d in digits)
+    return text, float(scores[np.arange(len(digits)), digits].min())
+
+def _extract_text_with_templates(img_crop, field=None):
+    """使用模板比對提取數字，信心不足時退回 EasyOCR。"""
+    try:
+        text, score = _match_digits(img_crop)
+    except Exception as e:
+        print(f"模板比對辨識時發生錯誤: {e}")
+        text, score = "", 0.0
+    if score < TEMPLATE_MIN_SCORE:
+        return _extract_text_from_image(img_crop, field)
+    return int(text)
 
-def getCultureText(img):
-    cultureCrop = img.crop((489, 349, 579, 386))  # 左,上,右,下
-    return _extract_text_from_image(cultureCrop)
+def _extract_field(img_crop, engine, field=None):
+    """依指定的辨識引擎從裁切後的圖片中提取數字，並查詢/更新欄位指紋快取。"""
+    crop_np = np.asarray(img_crop)
+    if _roi_cache is not None:
+        cached = _roi_cache.get(crop_np)
+        if cached is not None:
+            incr("ocr.roi_cache_hits")
+            return cached
 
-def getAllProperties(img):
-    """提取所有屬性並返回一個字典。"""
+    with span("ocr.field", field=field, engine=engine):
+        if engine == ENGINE_TEMPLATE:
+            value = _extract_text_with_templates(img_crop, field)
+        else:
+            value = _extract_text_from_image(img_crop, field)
+
+    if _roi_cache is not None:
+        _roi_cache.put(crop_np, value)
+    return value
+
+def getMilitaryText(img, engine=ENGINE_EASYOCR):
+    militaryCrop = img.crop(FIELD_BOXES["Military"])
+    return _extract_field(militaryCrop, engine, "Military")
+
+def getTradeText(img, engine=ENGINE_EASYOCR):
+    tradeCrop = img.crop(FIELD_BOXES["Trade"])
+    return _extract_field(tradeCrop, engine, "Trade")
+
+def getTechText(img, engine=ENGINE_EASYOCR):
+    techCrop = img.crop(FIELD_BOXES["Tech"])
+    return _extract_field(techCrop, engine, "Tech")
+
+def getCultureText(img, engine=ENGINE_EASYOCR):
+    cultureCrop = img.crop(FIELD_BOXES["Culture"])
+    return _extract_field(cultureCrop, engine, "Culture")
+
+def getAllProperties(img, engine=ENGINE_EASYOCR):
+    """提取所有屬性並返回一個字典。
+
+    engine 可選 ENGINE_EASYOCR 或 ENGINE_TEMPLATE (模板比對，信心不足時退回 EasyOCR)。
+    """
     properties = {
-        "Military": getMilitaryText(img),
-        "Trade": getTradeText(img),
-        "Tech": getTechText(img),
-        "Culture": getCultureText(img)
+        "Military": getMilitaryText(img, engine),
+        "Trade": getTradeText(img, engine),
+        "Tech": getTechText(img, engine),
+        "Culture": getCultureText(img, engine)
     }
-    return properties 
\ No newline at end of file
+    return properties
+
+def getAllPropertiesFromRois(rois, engine=ENGINE_EASYOCR):
+    """從已二值化的各欄位裁切陣列 ({屬性: 陣列}，imagePreprocessor.binarize_rois 的結果) 提取所有屬性。"""
+    return {field: _extract_field(rois[field], engine, field) for field in FIELD_BOXES}
+
+def _field_rois(img):
+    """返回 {屬性: 灰階裁切陣列}；img 可以是已二值化的 PIL Image 或 binarize_rois 的結果。"""
+    if isinstance(img, dict):
+        return img
+    gray = img if img.mode == 'L' else img.convert('L')
+    return {field: np.asarray(gray.crop(box)) for field, box in FIELD_BOXES.items()}
+
+def lookup_roi_cache(images):
+    """查詢所有欄位的指紋快取。
+
+    參數:
+        images: dict，{名稱: 已二值化的 PIL Image，或 binarize_rois 返回的 {屬性: 二值化陣列}}
+    返回:
+        tuple: (結果, 未命中)；結果為 {名稱: 屬性字典}，只填入快取命中的欄位 (其餘為 None)，
+               未命中為 {名稱: {屬性: 裁切陣列}}，只包含需要辨識的欄位
+    """
+    results = {name: {field: None for field in FIELD_BOXES} for name in images}
+    misses = {}
+    hits = 0
+    for name, img in images.items():
+        for field, crop_np in _field_rois(img).items():
+            cached = _roi_cache.get(crop_np) if _roi_cache is not None else None
+            if cached is not None:
+                results[name][field] = cached
+                hits += 1
+            else:
+                misses.setdefault(name, {})[field] = crop_np
+    incr("ocr.roi_cache_hits", hits)
+    return results, misses
+
+def store_roi_cache(misses, results):
+    """將 lookup_roi_cache 未命中欄位的辨識結果寫入指紋快取。"""
+    if _roi_cache is None:
+        return
+    for name, rois in misses.items():
+        for field, crop_np in rois.items():
+            _roi_cache.put(crop_np, results[name][field])
+
+def getAllPropertiesBatch(images):
+    """一次批次辨識多張圖片的所有屬性。
+
+    裁切框是固定的且只包含數字，因此略過 CRAFT 文字偵測，
+    將所有圖片的所有裁切區域堆疊到同一張畫布上，只呼叫一次辨識器。
+
+    參數:
+        images: dict，{名稱: 已二值化的 PIL Image，或 binarize_rois 返回的 {屬性: 二值化陣列}}；
+                {屬性: 陣列} 可以只包含部分屬性，其餘屬性的結果為 None
+    返回:
+        dict: {名稱: 屬性字典}，屬性字典格式與 getAllProperties 相同
+    """
+    # 收集所有需要辨識的裁切區域 (名稱, 屬性, 灰階陣列)，指紋快取命中的欄位直接填入結果
+    results, misses = lookup_roi_cache(images)
+    crops = [(name, field, crop_np) for name, rois in misses.items() for field, crop_np in rois.items()]
+    if not crops:
+        return results
+
+    # 垂直堆疊到畫布上，並記錄每個區域的框 [x_min, x_max, y_min, y_max]
+    width = max(crop.shape[1] for _, _, crop in crops)
+    height = sum(crop.shape[0] + BATCH_ROW_GAP for _, _, crop in crops)
+    canvas = np.zeros((height, width), dtype=np.uint8)
+    boxes = []
+    y = 0
+    for _, _, crop in crops:
+        h, w = crop.shape
+        canvas[y:y + h, :w] = crop
+        boxes.append([0, w, y, y + h])
+        y += h + BATCH_ROW_GAP
+
+    try:
+        with span("ocr.batch", images=len(images), crops=len(crops)) as batch_span:
+            recognized = get_reader(OCR_USE_GPU).recognize(
+                canvas,
+                horizontal_list=boxes,
+                free_list=[],
+                allowlist=DIGIT_ALLOWLIST,
+                detail=1,
+                paragraph=False,
+                batch_size=len(boxes),
+            )
+            # 辨識結果可能被重新排序，以框的上緣座標對應回原本的區域
+            recognized_by_top = {int(box[0][1]): (text, confidence) for box, text, confidence in recognized}
+            fast_results = [recognized_by_top.get(top, ("", 0.0)) for _, _, top, _ in boxes]
+            # 批次辨識即為快速辨識，記錄每個欄位的信心 (放大辨識的信心另外記錄在 ocr.pass span)
+            batch_span.set(confidences=[
+                {"image": name, "field": field, "tier": "fast", "confidence": round(confidence, 4)}
+                for (name, field, _), (_, confidence) in zip(crops, fast_results)
+            ])
+    except Exception as e:
+        print(f"EasyOCR 批次辨識時發生錯誤: {e}")
+        return results
+
+    for (name, field, crop_np), fast in zip(crops, fast_results):
+        try:
+            # 只有信心不足的欄位才個別放大後重新辨識
+            text, _ = read_tiered(crop_np, field, OCR_USE_GPU, fast=fast, allowlist=DIGIT_ALLOWLIST)
+        except Exception as e:
+            print(f"EasyOCR 放大辨識時發生錯誤: {e}")
+            text = fast[0]
+        results[name][field] = _parse_digits(text)
+    store_roi_cache(misses, results)
+    return results
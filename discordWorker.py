@@ -0,0 +1,164 @@
+import asyncio
+import base64
+import json
+import os
+import socket
+import threading
+
+from selfBotExecutor import USER_TOKEN, MyClient, log, validate_token
+
+# 常駐的 Discord worker
+# 保持一個已登入的客戶端，按需掃描頻道並返回最新的國家圖片，
+# 只需要在啟動時付出一次登入與 READY 的時間。
+# 同一行程內可直接呼叫 DiscordWorker.get_latest_images()，
+# 其他行程 (例如排程執行的 main.py) 則透過 Unix socket 請求。
+
+WORKER_SOCKET_PATH = os.getenv('DISCORD_WORKER_SOCKET', '/tmp/ninesols_discord_worker.sock')
+READY_TIMEOUT = 60.0 # 等待客戶端 READY 的秒數
+REQUEST_TIMEOUT = 60.0 # 單次請求的秒數上限
+
+COMMAND_IMAGES = 'images' # 返回 {附件檔名: base64 圖片內容}
+COMMAND_URLS = 'urls' # 返回附件 URL 列表
+
+
+class DiscordWorker:
+    """在背景執行緒的事件迴圈中保持 Discord 連線，並提供讀取最新圖片的介面。"""
+
+    def __init__(self, token=USER_TOKEN):
+        self.token = token
+        self.loop = None
+        self.client = None
+        self._thread = None
+        self._client_task = None
+        self._scan_lock = None
+        self._server = None
+        self._loop_started = threading.Event()
+
+    def start(self):
+        """啟動背景事件迴圈並登入 Discord (不等待 READY)。"""
+        if self._thread and self._thread.is_alive():
+            return self
+        is_valid, validation_message = validate_token(self.token)
+        if not is_valid:
+            raise ValueError(f"TOKEN 錯誤: {validation_message}")
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="discord-worker", daemon=True)
+        self._thread.start()
+        self._loop_started.wait()
+        asyncio.run_coroutine_threadsafe(self._start_client(), self.loop).result()
+        log("Discord worker 已啟動，正在登入...")
+        return self
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._scan_lock = asyncio.Lock()
+        self._loop_started.set()
+        self.loop.run_forever()
+
+    async def _start_client(self):
+        self.client = MyClient(close_after_ready=False)
+        self._client_task = asyncio.ensure_future(self.client.start(self.token))
+
+    async def _scan(self, fetch_bytes):
+        """等待客戶端就緒後掃描頻道；同一時間只允許一次掃描。"""
+        if self._client_task.done():
+            raise RuntimeError(f"Discord 客戶端已停止: {self._client_task.exception()}")
+        await asyncio.wait_for(self.client.wait_until_ready(), timeout=READY_TIMEOUT)
+        async with self._scan_lock:
+            self.client.fetch_bytes = fetch_bytes
+            await self.client.read_state_status()
+            if fetch_bytes:
+                return dict(self.client.last_run_images)
+            return list(self.client.last_run_urls)
+
+    def get_latest_images(self, fetch_bytes=True, timeout=REQUEST_TIMEOUT):
+        """同步取得最新的國家圖片 ({附件檔名: 內容})，fetch_bytes=False 時返回 URL 列表。"""
+        future = asyncio.run_coroutine_threadsafe(self._scan(fetch_bytes), self.loop)
+        return future.result(timeout)
+
+    def serve_unix_socket(self, path=WORKER_SOCKET_PATH):
+        """在 Unix socket 上提供讀取服務，讓其他行程共用這個已登入的客戶端。"""
+        asyncio.run_coroutine_threadsafe(self._start_server(path), self.loop).result()
+        log(f"Discord worker 正在監聽 {path}")
+
+    async def _start_server(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=path)
+
+    async def _handle_connection(self, reader, writer):
+        """每個連線讀取一行指令，回覆一行 JSON 後關閉。"""
+        try:
+            command = (await reader.readline()).decode('utf-8').strip()
+            if command == COMMAND_IMAGES:
+                images = await self._scan(fetch_bytes=True)
+                payload = {"ok": True, "images": {
+                    filename: base64.b64encode(content).decode('ascii') for filename, content in images.items()
+                }}
+            elif command == COMMAND_URLS:
+                payload = {"ok": True, "urls": await self._scan(fetch_bytes=False)}
+            else:
+                payload = {"ok": False, "error": f"未知的指令: {command}"}
+        except Exception as e:
+            print(f"處理 Discord worker 請求時發生錯誤: {e}")
+            payload = {"ok": False, "error": str(e)}
+        try:
+            writer.write(json.dumps(payload).encode('utf-8') + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def stop(self):
+        """關閉 socket 服務與 Discord 客戶端，並停止背景事件迴圈。"""
+        if not self.loop or not self._thread:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=REQUEST_TIMEOUT)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=REQUEST_TIMEOUT)
+        log("Discord worker 已停止")
+
+    async def _shutdown(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self.client and not self.client.is_closed():
+            await self.client.close()
+
+
+def request_images_from_worker(path=WORKER_SOCKET_PATH, fetch_bytes=True, timeout=REQUEST_TIMEOUT):
+    """透過 Unix socket 向常駐的 DiscordWorker 請求最新圖片。
+
+    返回:
+        dict: {附件檔名: 圖片內容}；fetch_bytes=False 時返回 URL 列表
+    """
+    command = COMMAND_IMAGES if fetch_bytes else COMMAND_URLS
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(f"{command}\n".encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    payload = json.loads(b"".join(chunks).decode('utf-8'))
+    if not payload.get("ok"):
+        raise RuntimeError(payload.get("error", "Discord worker 返回錯誤"))
+    if fetch_bytes:
+        return {filename: base64.b64decode(data) for filename, data in payload["images"].items()}
+    return payload["urls"]
+
+
+if __name__ == "__main__":
+    # 以常駐模式執行: DISCORD_WORKER_SOCKET=/tmp/x.sock python discordWorker.py
+    # 之後 main.py (設定相同的 DISCORD_WORKER_SOCKET) 會透過 socket 取得圖片，不再每次登入
+    worker = DiscordWorker().start()
+    worker.serve_unix_socket(WORKER_SOCKET_PATH)
+    print(f"Discord worker 執行中，socket: {WORKER_SOCKET_PATH}，按 Ctrl+C 結束")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("正在停止 Discord worker...")
+    finally:
+        worker.stop()
@@ -0,0 +1,52 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from runMetrics import span
+
+# 下載 Discord 附件圖片 (並行由呼叫端的執行緒池負責，例如 tryChanSelfBot 的 io_executor)
+# 共用一個保持連線 (keep-alive) 的 Session，避免每張圖片都重新建立 TLS 連線
+
+DOWNLOAD_TIMEOUT = 15 # 每個請求的超時秒數 (連線與讀取)
+MAX_IMAGE_BYTES = 8 * 1024 * 1024 # 單張圖片的大小上限
+MAX_DOWNLOAD_WORKERS = 8 # 連線池大小 (同時進行的下載數)
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class ImageTooLargeError(requests.exceptions.RequestException):
+    """圖片超過 MAX_IMAGE_BYTES 時拋出。"""
+
+
+def get_session():
+    """返回共用的 requests.Session，連線池大小與下載執行緒數一致。"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_DOWNLOAD_WORKERS, pool_maxsize=MAX_DOWNLOAD_WORKERS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+def download_image_bytes(url, timeout=DOWNLOAD_TIMEOUT, max_bytes=MAX_IMAGE_BYTES):
+    """下載單張圖片並返回內容，超過 max_bytes 時拋出 ImageTooLargeError。"""
+    with span("download", url=url.split("?")[0]) as download_span, \
+            get_session().get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status() # 檢查 HTTP 錯誤
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise ImageTooLargeError(f"圖片大小 {content_length} bytes 超過上限 {max_bytes} bytes: {url}")
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            received += len(chunk)
+            if received > max_bytes:
+                raise ImageTooLargeError(f"圖片大小超過上限 {max_bytes} bytes: {url}")
+            chunks.append(chunk)
+        download_span.set(bytes=received)
+        return b"".join(chunks)
@@ -0,0 +1,63 @@
+import functools
+
+import cv2
+import numpy as np
+
+# 狀態圖的二值化處理，供 main.py 與 tryChanSelfBot.py 共用
+# 以查表 (LUT) 與 NumPy 陣列運算取代逐像素的 Python 迴圈
+
+GRAY_THRESHOLD = 128 # 灰階值大於此值視為白色 (main.py)
+CHANNEL_THRESHOLD = 150 # 任一色彩通道大於等於此值視為白色 (tryChanSelfBot.py)
+
+@functools.lru_cache(maxsize=None)
+def _gray_lut(threshold):
+    """灰階二值化查表：大於 threshold 為 255，其餘為 0。"""
+    return [255 if p > threshold else 0 for p in range(256)]
+
+def preprocess_image(img, threshold=GRAY_THRESHOLD):
+    """將 PIL 圖片轉換為灰階並進行二值化處理。
+
+    結果與 gray_img.point(lambda p: p > threshold and 255) 逐位元組相同。
+    """
+    gray_img = img.convert('L')
+    return gray_img.point(_gray_lut(threshold))
+
+# PIL convert('L') 的 ITU-R 601-2 定點係數 (B, G, R 順序)，(總和 + 0x8000) >> 16 即為灰階值
+_GRAY_WEIGHTS = np.array([7471, 38470, 19595], dtype=np.uint32)
+
+def decode_image(content):
+    """將圖片位元組解碼為一個 BGR NumPy 陣列 (只解碼一次，不做灰階轉換或複製)。"""
+    frame = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError(f"無法解碼圖片 ({len(content)} bytes)")
+    return frame
+
+def binarize_roi(frame, box, threshold=GRAY_THRESHOLD):
+    """只對 frame 中的 box (左,上,右,下) 區域做灰階二值化，返回該區域大小的新陣列。
+
+    區域以切片 (view) 取得，框外的像素不會被轉換或複製；結果與 preprocess_image 後再 crop 逐位元組相同。
+    """
+    left, top, right, bottom = box
+    roi = frame[top:bottom, left:right]
+    gray = (roi @ _GRAY_WEIGHTS + 0x8000) >> 16
+    return np.where(gray > threshold, np.uint8(255), np.uint8(0))
+
+def binarize_rois(content, boxes, threshold=GRAY_THRESHOLD):
+    """解碼圖片一次，並只二值化 boxes ({名稱: (左,上,右,下)}) 中的區域，返回 {名稱: 二值化陣列}。"""
+    frame = decode_image(content)
+    return {name: binarize_roi(frame, box, threshold) for name, box in boxes.items()}
+
+@functools.lru_cache(maxsize=None)
+def _channel_lut(threshold):
+    """通道二值化查表：大於等於 threshold 為 255，其餘為 0。"""
+    return np.where(np.arange(256) >= threshold, 255, 0).astype(np.uint8)
+
+def binarize_any_channel(img, threshold=CHANNEL_THRESHOLD):
+    """將 OpenCV (BGR) 圖片二值化：任一通道 >= threshold 的像素設為白色，其餘為黑色。
+
+    返回與輸入相同形狀的新陣列，結果與原本逐像素檢查三個通道的迴圈相同。
+    """
+    # 任一通道 >= threshold 等價於三個通道的最大值 >= threshold
+    channel_max = np.maximum(np.maximum(img[..., 0], img[..., 1]), img[..., 2])
+    binary = _channel_lut(threshold)[channel_max]
+    return np.repeat(binary[..., None], img.shape[2], axis=2)
@@ -0,0 +1,97 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# 離線負載測試: 以 localStandIns 的合成圖片來源與工作表替身多次執行 main.main，
+# 找出國家數量增加時的吞吐量上限。
+#   python loadTest.py --countries 300 --runs 5 --change-rate 0.3 --sheet-latency 0.5 --quota-error-rate 0.2
+
+# OCR 快取與執行報告寫在暫存目錄 (必須在匯入 ocrCache / runMetrics 之前設定)
+_WORK_DIR = tempfile.mkdtemp(prefix="ninesols-load-")
+os.environ["OCR_CACHE_DIR"] = os.path.join(_WORK_DIR, "ocr_cache")
+os.environ.setdefault("RUN_REPORT_FILE", os.path.join(_WORK_DIR, "run_report.jsonl"))
+
+import main
+import sheetWriter
+from localStandIns import FakeWorksheet, SyntheticImageSource
+from runMetrics import RUN_REPORT_FILE
+
+
+def _last_summary(path=RUN_REPORT_FILE):
+    """讀取執行報告的最後一行 (最近一次執行的彙總)。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+def run_load_test(countries, runs, change_rate, sheet_latency, quota_error_rate, seed=None, verbose=False):
+    source = SyntheticImageSource(countries, change_rate=change_rate, seed=seed)
+    worksheet = FakeWorksheet(latency=sheet_latency, quota_error_rate=quota_error_rate, seed=seed)
+    results = []
+    for run_index in range(1, runs + 1):
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        start = time.perf_counter()
+        with output:
+            written = main.main(source=source, worksheet=worksheet) or []
+        elapsed = time.perf_counter() - start
+        expected = {main.get_country_filename(filename): values for filename, values in source.expected.items()}
+        correct = sum(task["properties"] == expected.get(task["filename"]) for task in written)
+        summary = _last_summary() or {}
+        result = {
+            "run": run_index,
+            "seconds": round(elapsed, 3),
+            "images_per_second": round(countries / elapsed, 2) if elapsed > 0 else None,
+            "written": len(written),
+            "correct": correct,
+            "result_cache": summary.get("values", {}).get("result_cache"),
+            "stages": {name: stage["total_ms"] for name, stage in summary.get("stages", {}).items()},
+            "sheet": worksheet.stats(),
+            "sheet_retries": summary.get("counters", {}).get("sheet.retries", 0),
+        }
+        results.append(result)
+        print(f"第 {run_index} 次: {result['seconds']:.2f} 秒，{result['images_per_second']} 張/秒，"
+              f"寫入 {len(written)}/{countries}，正確 {correct}，Sheets 重試 {result['sheet_retries']} 次")
+    return {
+        "countries": countries,
+        "runs": runs,
+        "change_rate": change_rate,
+        "sheet_latency": sheet_latency,
+        "quota_error_rate": quota_error_rate,
+        "results": results,
+    }
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="以本地替身對 main.main 進行負載測試")
+    parser.add_argument("--countries", type=int, default=100, help="合成國家數")
+    parser.add_argument("--runs", type=int, default=3, help="執行次數 (第一次之後只有部分國家會變化)")
+    parser.add_argument("--change-rate", type=float, default=0.3, help="每次執行數值有變化的國家比例")
+    parser.add_argument("--sheet-latency", type=float, default=0.2, help="每次 Sheets API 呼叫的延遲秒數")
+    parser.add_argument("--quota-error-rate", type=float, default=0.1, help="每次 Sheets API 呼叫回傳 429 的機率")
+    parser.add_argument("--backoff-base", type=float, default=0.05, help="配額錯誤重試的起始等待秒數")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="將結果寫成 JSON")
+    parser.add_argument("--verbose", action="store_true", help="顯示 main.main 的輸出")
+    args = parser.parse_args(argv)
+
+    sheetWriter.QUOTA_BASE_DELAY = args.backoff_base
+    try:
+        report = run_load_test(args.countries, args.runs, args.change_rate, args.sheet_latency,
+                               args.quota_error_rate, args.seed, args.verbose)
+    finally:
+        shutil.rmtree(_WORK_DIR, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,154 @@
+import glob
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import gspread
+import numpy as np
+import requests
+from PIL import Image
+
+from countryInfoExtractor import FIELD_BOXES, TEMPLATE_SAMPLE_LABELS, _segment_glyphs
+from sheetWriter import SHEET_HEADER
+
+# Discord 與 Google Sheets 的本地替身，用於離線的大量負載測試
+#   SyntheticImageSource: 以內附的二值化狀態圖為底，填入不同數字產生任意數量的國家圖片
+#   FakeWorksheet: 記錄寫入內容，並模擬每次 API 呼叫的延遲與配額錯誤 (429)
+# 兩者的介面與 main.main 使用的來源 (fetch) 與工作表 (append_rows 等) 相同。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load_glyph_library():
+    """從內附的樣本切出每個數字的字元圖 (布林陣列) 以及字元之間的間距中位數。"""
+    glyphs = {str(digit): [] for digit in range(10)}
+    gaps = []
+    for filename, labels in TEMPLATE_SAMPLE_LABELS.items():
+        img = np.asarray(Image.open(os.path.join(BASE_DIR, filename)).convert('L'))
+        for (left, top, right, bottom), label in zip(FIELD_BOXES.values(), labels):
+            segmented = _segment_glyphs(img[top:bottom, left:right], with_columns=True)
+            if len(segmented) != len(label):
+                continue
+            for (_, _, glyph), digit in zip(segmented, label):
+                glyphs[digit].append(glyph)
+            gaps.extend(next_start - end for (_, end, _), (next_start, _, _) in zip(segmented, segmented[1:]))
+    return glyphs, int(np.median(gaps)) if gaps else 2
+
+
+class SyntheticImageSource:
+    """產生 count 個合成國家狀態圖的圖片來源。
+
+    每次 fetch() 時約有 change_rate 比例的國家數值增長 (其餘圖片內容不變，可測試快取命中)。
+    expected 記錄每張附件目前的正確數值，可用來檢查辨識正確率。
+    """
+
+    name = "synthetic"
+
+    def __init__(self, count=8, change_rate=0.5, seed=None):
+        self.count = count
+        self.change_rate = change_rate
+        self._random = random.Random(seed)
+        self._glyphs, self._gap = _load_glyph_library()
+        self._bases = [np.asarray(Image.open(path).convert('L'))
+                       for path in sorted(glob.glob(os.path.join(BASE_DIR, "binary_CountryState_*.png")))]
+        self.expected = {} # 附件檔名 -> {屬性: 數值}
+        self._images = {} # 附件檔名 -> PNG 內容
+        for index in range(count):
+            filename = f"CountryState_Synthetic{index:04d}.png"
+            self.expected[filename] = {field: self._random.randint(1000, 8999) for field in FIELD_BOXES}
+            self._images[filename] = self._render(index, self.expected[filename])
+        self.fetches = 0
+
+    def _render(self, index, values):
+        """在底圖的每個欄位中清除原本的數字，置中貼上新的數字，返回 PNG 內容。"""
+        frame = self._bases[index % len(self._bases)].copy()
+        for field, (left, top, right, bottom) in FIELD_BOXES.items():
+            region = frame[top:bottom, left:right]
+            old_rows = np.flatnonzero((region > 127).any(axis=1))
+            glyphs = [self._random.choice(self._glyphs[digit]) for digit in str(values[field])]
+            width = sum(glyph.shape[1] for glyph in glyphs) + self._gap * (len(glyphs) - 1)
+            region[:] = 0
+            x = max(0, (region.shape[1] - width) // 2)
+            y = old_rows[0] if len(old_rows) else 0
+            for glyph in glyphs:
+                h, w = glyph.shape
+                h = min(h, region.shape[0] - y)
+                w = min(w, region.shape[1] - x)
+                region[y:y + h, x:x + w][glyph[:h, :w]] = 255
+                x += w + self._gap
+        buffer = io.BytesIO()
+        Image.fromarray(frame).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def fetch(self):
+        """返回 (成功, {附件檔名: 圖片內容})，介面與 selfBotExecutor.DiscordImageSource.fetch 相同。"""
+        if self.fetches:
+            for index, filename in enumerate(self._images):
+                if self._random.random() < self.change_rate:
+                    values = self.expected[filename]
+                    field = self._random.choice(list(FIELD_BOXES))
+                    values[field] = min(9999, values[field] + self._random.randint(1, 50))
+                    self._images[filename] = self._render(index, values)
+        self.fetches += 1
+        return True, dict(self._images)
+
+
+def _quota_error():
+    """建立與 Google Sheets 配額用盡時相同的 gspread APIError (HTTP 429)。"""
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps({"error": {
+        "code": 429, "message": "Quota exceeded (simulated)", "status": "RESOURCE_EXHAUSTED",
+    }}).encode("utf-8")
+    return gspread.exceptions.APIError(response)
+
+
+class FakeWorksheet:
+    """Google Sheets 工作表替身，記錄所有寫入並模擬延遲與配額錯誤。
+
+    參數:
+        latency: 每次 API 呼叫的延遲秒數
+        quota_error_rate: 每次 API 呼叫拋出 429 的機率
+    """
+
+    title = "Logs"
+
+    def __init__(self, latency=0.0, quota_error_rate=0.0, seed=None):
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.rows = [list(SHEET_HEADER)]
+        self.api_calls = 0
+        self.quota_errors = 0
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.api_calls += 1
+            if self.quota_error_rate and self._random.random() < self.quota_error_rate:
+                self.quota_errors += 1
+                raise _quota_error()
+
+    def row_values(self, index):
+        self._call()
+        return list(self.rows[index - 1]) if index <= len(self.rows) else []
+
+    def delete_rows(self, index):
+        self._call()
+        del self.rows[index - 1]
+
+    def insert_row(self, values, index):
+        self._call()
+        self.rows.insert(index - 1, list(values))
+
+    def append_rows(self, rows, value_input_option=None):
+        self._call()
+        self.rows.extend(list(row) for row in rows)
+
+    def stats(self):
+        return {"rows": len(self.rows) - 1, "api_calls": self.api_calls, "quota_errors": self.quota_errors}
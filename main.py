@@ -1,17 +1,22 @@
 import datetime
 import json  # 引入 json 模組
 import os  # 引入 os 模組
-import time  # 引入 time 模組
-from io import BytesIO
+import time
 
 import gspread
 import pytz  # 引入 pytz 用於時區處理
-import requests
 from google.oauth2.service_account import Credentials
-from PIL import Image
 
-from countryInfoExtractor import getAllProperties
-from selfBotExecutor import get_discord_images_sync  # 引入從 Discord 獲取圖片的函數
+from countryInfoExtractor import (FIELD_BOXES, OCR_USE_GPU, getAllPropertiesBatch, getAllPropertiesFromRois, lookup_roi_cache,
+                                  store_roi_cache, use_roi_cache)
+from imagePreprocessor import binarize_rois  # 只解碼一次並只二值化各欄位區域
+from ocrCache import ImageResultCache, RoiFingerprintCache
+from ocrReader import warm_up_reader
+from ocrWorkerPool import OcrWorkerPool
+from pipeline import Pipeline, Stage
+from runMetrics import finish_run, record_span, set_value, span, start_run
+from selfBotExecutor import DiscordImageSource  # 從 Discord 獲取圖片的來源
+from sheetWriter import SHEET_HEADER, SheetRowBuffer
 
 # --- Google Sheets 設定 ---
 # 優先從環境變數讀取憑證內容 (用於 GitHub Actions)
@@ -25,6 +30,12 @@ CREDENTIALS_FILE = 'nine-sols-754f9adc71aa.json'
 SPREADSHEET_URL = 'https://docs.google.com/spreadsheets/d/1_dQZCbZjqBTNgXKay_zd3YrxaDvuH5uu4Hz7-wLCI6g/edit?usp=sharing' # <-- Google Sheet 的 URL
 SPREADSHEET_NAME = '《 九日 | 混元萬劫 》奄國 | 國民能力表及任務列表' # <-- 用於顯示，可選
 WORKSHEET_NAME = 'Logs' # <-- 通常是 'Sheet1'，如果您的工作表名稱不同請修改
+SHEET_FLUSH_SIZE = int(os.environ.get('SHEET_FLUSH_SIZE', '100')) # 暫存多少行後寫入一次
+# 設為 1 時以多行程平行辨識 (行程數與 torch 執行緒數見 ocrWorkerPool 的 OCR_POOL_WORKERS / OCR_TORCH_THREADS)
+OCR_PARALLEL = os.environ.get('OCR_PARALLEL') == '1'
+# 管線各階段的並行度
+PIPELINE_DECODE_WORKERS = int(os.environ.get('PIPELINE_DECODE_WORKERS', '2'))
+PIPELINE_OCR_BATCH_SIZE = int(os.environ.get('PIPELINE_OCR_BATCH_SIZE', '8')) # OCR 階段一次最多合併辨識的圖片數
 
 # Google API 的範圍
 SCOPES = [
@@ -36,11 +47,10 @@ SCOPES = [
 # --- 定義 UTC+8 時區 ---
 UTC8 = pytz.timezone('Asia/Shanghai') # 或者 'Asia/Taipei', 'Asia/Hong_Kong' 等
 
-def preprocess_image(img, threshold=128):
-    """將圖片轉換為灰階並進行二值化處理。"""
-    gray_img = img.convert('L')
-    binary_img = gray_img.point(lambda p: p > threshold and 255)
-    return binary_img
+def get_country_filename(url):
+    """從 Discord 附件 URL 或附件檔名取出國家檔名，例如 'Yiguo'"""
+    base_filename = url.split('/')[-1].split('?')[0]
+    return base_filename.removeprefix("CountryState_").removesuffix(".png")
 
 def get_current_utc8_time_str():
     """獲取當前 UTC+8 時間並格式化為字符串"""
@@ -48,8 +58,40 @@ def get_current_utc8_time_str():
     utc8_now = utc_now.astimezone(UTC8)
     return utc8_now.strftime("%Y-%m-%d %H:%M:%S")
 
-def main():
-    # --- Google Sheets 驗證與開啟 ---
+def build_row(filename, properties):
+    """準備要寫入 Google Sheet 的行數據 (與標頭欄位順序一致)"""
+    return [
+        filename,
+        properties.get("Military", ""),
+        properties.get("Trade", ""),
+        properties.get("Tech", ""),
+        properties.get("Culture", ""),
+        get_current_utc8_time_str() # 使用 UTC+8 時間
+    ]
+
+def main(source=None, worksheet=None):
+    """取得狀態圖、辨識並寫入 Google Sheet。
+
+    參數:
+        source: 圖片來源，需提供 fetch() -> (成功, {附件檔名: 圖片內容})；預設為 Discord
+        worksheet: 寫入目標，需提供 gspread.Worksheet 的 append_rows；預設依憑證開啟 Google Sheet
+        (本地替身見 localStandIns)
+    返回:
+        list: 成功辨識並寫入的項目；無法開始處理時返回 None
+    """
+    # 記錄各階段耗時，結束時寫入 runMetrics.RUN_REPORT_FILE
+    start_run("main")
+    try:
+        return run(source, worksheet)
+    finally:
+        run_summary = finish_run()
+        if run_summary:
+            print(f"執行報告: 共 {run_summary['duration_ms'] / 1000:.2f} 秒")
+            for stage_name, stage in sorted(run_summary["stages"].items(), key=lambda item: -item[1]["total_ms"]):
+                print(f"  {stage_name}: {stage['count']} 次，共 {stage['total_ms']:.1f} ms，最長 {stage['max_ms']:.1f} ms")
+
+def open_worksheet():
+    """驗證憑證並開啟 Google Sheet 的工作表 (標頭不符時重新寫入)，失敗時印出原因並返回 None。"""
     try:
         creds = None
         if CREDENTIALS_JSON_CONTENT:
@@ -62,8 +104,9 @@ def main():
             creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
         else:
             print(f"錯誤：找不到 Google 憑證。請確保 '{CREDENTIALS_FILE}' 存在於本地，或已設定 'GOOGLE_CREDENTIALS_JSON' 環境變數。")
-            return
+            return None
 
+        connect_started = time.perf_counter()
         gc = gspread.authorize(creds)
         # 使用 URL 開啟 Sheet
         sh = gc.open_by_url(SPREADSHEET_URL)
@@ -71,7 +114,7 @@ def main():
         print(f"成功連接到 Google Sheet (透過 URL): '{sh.title}' -> '{worksheet.title}'")
 
         # 檢查標頭是否存在，如果不存在則寫入
-        header = ["國家", "軍事", "商業", "科技", "文化", "更新時間"]
+        header = SHEET_HEADER
         first_row = worksheet.row_values(1)
         if not first_row or first_row != header: # 檢查是否為空或不匹配
             # 如果第一行不為空但與期望標頭不同，先刪除第一行再插入新標頭
@@ -80,184 +123,157 @@ def main():
                 print("已刪除舊標頭行。")
             worksheet.insert_row(header, 1)
             print("已寫入標頭到 Google Sheet")
+        record_span("sheet.connect", connect_started)
+        return worksheet
 
     except FileNotFoundError: # 這個錯誤現在只會在嘗試讀取本地檔案但不存在時發生
         print(f"錯誤：找不到憑證檔案 '{CREDENTIALS_FILE}'。請確保檔案存在且路徑正確。")
-        return
+        return None
     except json.JSONDecodeError:
         print("錯誤：解析環境變數 'GOOGLE_CREDENTIALS_JSON' 中的 JSON 內容失敗。請檢查 GitHub Secrets 中的值是否為有效的 JSON。")
-        return
+        return None
     except gspread.exceptions.APIError as e:
         # 更具體地處理權限或 API 未啟用的錯誤
         if e.response.status_code == 403:
             print(f"錯誤：權限不足或 API 未啟用。請確保服務帳戶已共享至 Sheet ('{SPREADSHEET_URL}') 並具有編輯權限，且 Google Drive API 和 Sheets API 已啟用。錯誤詳情: {e}")
         else:
             print(f"連接 Google Sheets 時發生 API 錯誤: {e}")
-        return
+        return None
     except gspread.exceptions.SpreadsheetNotFound:
         # 這個錯誤現在不太可能發生，因為 URL 通常是唯一的
         print(f"錯誤：透過 URL '{SPREADSHEET_URL}' 找不到 Google Sheet。請確認 URL 正確且服務帳戶有權限存取。")
-        return
+        return None
     except gspread.exceptions.WorksheetNotFound:
         print(f"錯誤：在 '{sh.title if 'sh' in locals() else SPREADSHEET_URL}' 中找不到名為 '{WORKSHEET_NAME}' 的工作表。")
-        return
+        return None
     except Exception as e:
         print(f"連接 Google Sheets 時發生未預期的錯誤: {e}")
-        return
-    # --- Google Sheets 驗證與開啟結束 ---
-
-    # 從 Discord 獲取圖片 URL，因為 Discord 的 URL 會過期
-    print("正在從 Discord 獲取最新圖片 URL...")
-    success, discord_urls = get_discord_images_sync()
-    
-    if not success or not discord_urls:
-        print("錯誤：無法從 Discord 獲取圖片 URL")
-        return  # 如果無法獲取 URL，終止程序
-    
-    print(f"成功從 Discord 獲取了 {len(discord_urls)} 個圖片 URL")
-    
-    # 使用從 Discord 獲取的 URL
-    image_urls = discord_urls
-
-    failed_urls = [] # 記錄第一輪處理失敗的 URL
-
-    print("--- 開始第一輪圖片處理 ---")
-    for url in image_urls:
-        try:
-            base_filename = url.split('/')[-1].split('?')[0]
-            filename = base_filename.removeprefix("CountryState_").removesuffix(".png")
-            print(f"--- 正在處理 (第一輪): {filename} ---")
-
-            # 下載圖片
-            response = requests.get(url, timeout=15) # 增加超時時間
-            response.raise_for_status() # 檢查 HTTP 錯誤
-
-            # 處理圖片
-            img = Image.open(BytesIO(response.content))
-            processed_img = preprocess_image(img)
-
-            # 獲取屬性字典
-            properties = getAllProperties(processed_img)
-            print(f"  提取結果 (第一輪): {properties}")
-
-            # 準備要寫入 Google Sheet 的行數據
-            timestamp = get_current_utc8_time_str() # 使用 UTC+8 時間
-            row_data = [
-                filename,
-                properties.get("Military", ""),
-                properties.get("Trade", ""),
-                properties.get("Tech", ""),
-                properties.get("Culture", ""),
-                timestamp
-            ]
-
-            # 將數據附加到 Google Sheet
-            worksheet.append_row(row_data, value_input_option='USER_ENTERED')
-            print(f"  數據已寫入 Google Sheet: {row_data}")
-            print("-----------------------------------")
-
-            # 短暫暫停
-            time.sleep(1.5)
-
-        except requests.exceptions.RequestException as e:
-            print(f"  下載圖片時發生錯誤 (第一輪) {url}: {e}")
-            failed_urls.append(url) # 記錄失敗的 URL
-            continue # 繼續處理下一個 URL
-        except Exception as e:
-            # 捕捉圖片處理 (PIL, easyocr) 或 getAllProperties 的錯誤
-            # 但排除 Google Sheet 的錯誤 (gspread exceptions 在主 try 外處理)
-            if not isinstance(e, gspread.exceptions.GSpreadException): # 確保不是 gspread 錯誤
-                print(f"  處理圖片時發生錯誤 (第一輪) ({url}): {e}")
-                # 打印詳細錯誤
-                import traceback
-                traceback.print_exc()
-                failed_urls.append(url) # 記錄失敗的 URL
-                continue # 繼續處理下一個 URL
-            else:
-                # 如果是 gspread 錯誤，則向上拋出，由外層處理
-                raise e 
+        return None
 
-    # --- 第二輪重試處理 --- 
-    if failed_urls:
-        print(f"--- 第一輪處理完成，有 {len(failed_urls)} 個 URL 處理失敗，開始第二輪重試 ---")
-        print("重新從 Discord 獲取最新圖片 URL...")
-        success_retry, fresh_discord_urls = get_discord_images_sync()
-
-        if not success_retry or not fresh_discord_urls:
-            print("錯誤：無法為第二輪重試獲取新的 Discord URL，放棄重試。")
-        else:
-            print(f"成功為第二輪重試獲取了 {len(fresh_discord_urls)} 個新 URL")
-            
-            # 創建新 URL 的查找字典 (檔名 -> 新 URL)
-            fresh_url_map = {}
-            for fresh_url in fresh_discord_urls:
-                try:
-                    base_filename = fresh_url.split('/')[-1].split('?')[0]
-                    filename = base_filename.removeprefix("CountryState_").removesuffix(".png")
-                    fresh_url_map[filename] = fresh_url
-                except Exception as e:
-                    print(f"解析新獲取的 URL 時出錯 {fresh_url}: {e}")
-            
-            print(f"開始處理 {len(failed_urls)} 個之前失敗的 URL (第二輪)... ")
-            # 遍歷之前失敗的 URL
-            for old_failed_url in failed_urls:
-                 try:
-                    old_base_filename = old_failed_url.split('/')[-1].split('?')[0]
-                    old_filename = old_base_filename.removeprefix("CountryState_").removesuffix(".png")
-                    
-                    # 查找對應的新 URL
-                    new_url_to_retry = fresh_url_map.get(old_filename)
-                    
-                    if not new_url_to_retry:
-                        print(f"  未能在新獲取的列表中找到 {old_filename} 的對應 URL，跳過重試。")
-                        continue
-
-                    print(f"--- 正在重試處理 (第二輪): {old_filename} 使用新 URL ---")
-                    # print(f"   舊URL: {old_failed_url}") # 可選：打印舊 URL 以供對比
-                    # print(f"   新URL: {new_url_to_retry}") # 可選：打印新 URL
-
-                    # --- 在這裡複製第一輪的處理邏輯，但不再記錄失敗 --- 
-                    response = requests.get(new_url_to_retry, timeout=15)
-                    response.raise_for_status()
-
-                    img = Image.open(BytesIO(response.content))
-                    processed_img = preprocess_image(img)
-
-                    properties = getAllProperties(processed_img)
-                    print(f"  提取結果 (第二輪): {properties}")
-
-                    timestamp = get_current_utc8_time_str() # 使用 UTC+8 時間
-                    row_data = [
-                        old_filename, # 使用原始檔名
-                        properties.get("Military", ""),
-                        properties.get("Trade", ""),
-                        properties.get("Tech", ""),
-                        properties.get("Culture", ""),
-                        timestamp
-                    ]
-
-                    worksheet.append_row(row_data, value_input_option='USER_ENTERED')
-                    print(f"  數據已寫入 Google Sheet (第二輪): {row_data}")
-                    print("-----------------------------------")
-                    time.sleep(1.5)
-
-                 except requests.exceptions.RequestException as e:
-                    print(f"  下載圖片時發生錯誤 (第二輪) {new_url_to_retry}: {e}")
-                    # 第二輪不再重試，直接繼續下一個
-                    continue 
-                 except Exception as e:
-                    if not isinstance(e, gspread.exceptions.GSpreadException):
-                         print(f"  處理圖片時發生錯誤 (第二輪) ({new_url_to_retry}): {e}")
-                         import traceback
-                         traceback.print_exc()
-                         # 第二輪不再重試，直接繼續下一個
-                         continue
-                    else:
-                        raise e # 向上拋出 gspread 錯誤
-            print("--- 第二輪重試處理結束 ---")
-            
+def run(source=None, worksheet=None):
+    # --- Google Sheets 驗證與開啟 ---
+    if worksheet is None:
+        worksheet = open_worksheet()
+        if worksheet is None:
+            return None
+    source = source or DiscordImageSource()
+
+    # Google Sheets 連線成功後才載入 OCR 模型，與 Discord 抓取同時進行
+    ocr_pool = None
+    if OCR_PARALLEL:
+        # 多行程模式：工作行程各自載入 Reader，主行程不需要載入
+        # 工作行程在第一次提交工作時才會啟動，因此先在背景啟動，讓模型載入與 Discord 抓取重疊
+        ocr_pool = OcrWorkerPool(gpu=OCR_USE_GPU)
+        ocr_pool.warm_up(background=True)
     else:
-        print("--- 第一輪處理完成，所有 URL 均成功處理 --- ")
+        warm_up_reader(OCR_USE_GPU)
+
+    # Discord 來源在連線期間直接讀取附件內容，簽名 URL 過期不再影響後續處理
+    print(f"正在從 {source.name} 獲取最新圖片...")
+    success, discord_images = source.fetch()
+
+    if not success or not discord_images:
+        print(f"錯誤：無法從 {source.name} 獲取圖片")
+        if ocr_pool:
+            ocr_pool.close()
+        return None  # 如果無法獲取圖片，終止程序
+
+    print(f"成功從 {source.name} 獲取了 {len(discord_images)} 張圖片")
+
+    sheet_buffer = SheetRowBuffer(worksheet, flush_size=SHEET_FLUSH_SIZE)
+
+    # 以圖片內容雜湊查詢上次的辨識結果，內容沒變的國家直接略過二值化與 OCR
+    result_cache = ImageResultCache()
+    # 圖片有變動時，只有像素改變的欄位才送去 OCR
+    roi_cache = RoiFingerprintCache()
+    use_roi_cache(roi_cache)
+
+    def decode_stage(item):
+        """查詢結果快取，未命中時解碼並二值化圖片 (多執行緒)。"""
+        attachment_filename, content = item
+        filename = get_country_filename(attachment_filename)
+        print(f"--- 正在處理: {filename} ({len(content)} bytes) ---")
+        task = {"filename": filename, "content": content}
+        cached_properties = result_cache.get(content)
+        if cached_properties is not None:
+            print(f"  圖片內容未變更，使用快取結果: {filename}")
+            task["properties"] = cached_properties
+        else:
+            # 只有各欄位的區域會被二值化 (其餘約 95% 的像素不做轉換或複製)
+            # 解碼錯誤會由管線記錄，內容不會改變，因此不重試
+            with span("binarize", file=filename, bytes=len(content)):
+                task["image"] = binarize_rois(content, FIELD_BOXES)
+        return task
+
+    def ocr_stage(tasks):
+        """辨識已就緒的一批圖片；批次辨識失敗的圖片改用逐張 (含文字偵測) 的辨識重試。"""
+        pending = {task["filename"]: task["image"] for task in tasks if "properties" not in task}
+        recognized = {}
+        if pending and ocr_pool:
+            # 指紋快取在主行程查詢，只有未命中的欄位送到工作行程 (以不經文字偵測的批次辨識)
+            recognized, misses = lookup_roi_cache(pending)
+            if misses:
+                with span("ocr.pool", images=len(misses)):
+                    pool_results = ocr_pool.extract_properties(misses)
+                for name, rois in misses.items():
+                    for field in rois:
+                        recognized[name][field] = (pool_results[name] or {}).get(field)
+                store_roi_cache(misses, recognized)
+        elif pending:
+            print(f"--- 正在批次辨識 {len(pending)} 張圖片 ---")
+            recognized = getAllPropertiesBatch(pending)
+        for task in tasks:
+            if "properties" in task:
+                continue
+            properties = recognized.get(task["filename"]) or dict.fromkeys(FIELD_BOXES)
+            if all(value is None for value in properties.values()) and not ocr_pool:
+                print(f"--- 批次辨識失敗，正在重試: {task['filename']} ---")
+                properties = getAllPropertiesFromRois(task["image"])
+            result_cache.put(task["content"], properties)
+            task["properties"] = properties
+        for task in tasks:
+            print(f"  提取結果 {task['filename']}: {task['properties']}")
+        return [task for task in tasks if any(value is not None for value in task["properties"].values())]
+
+    # 只有解碼/二值化與 OCR 兩個階段以有界佇列連接並同時運作；
+    # 圖片在管線開始前已全部抓取完畢，Google Sheets 則在最後以單次呼叫寫入
+    ocr_workers = ocr_pool.workers if ocr_pool else 1
+    pipeline = Pipeline([
+        Stage("decode", decode_stage, workers=PIPELINE_DECODE_WORKERS),
+        Stage("ocr", ocr_stage, workers=ocr_workers, batch_size=PIPELINE_OCR_BATCH_SIZE),
+    ])
+    print("--- 開始處理圖片 ---")
+    written = pipeline.run(discord_images.items())
+    print(f"--- 圖片處理完成: {len(written)}/{len(discord_images)} 張圖片成功辨識 ---")
+    set_value("pipeline", pipeline.summary())
+    for stage_summary in pipeline.summary():
+        print(f"  階段 {stage_summary['stage']}: 處理 {stage_summary['processed']} 項，失敗 {stage_summary['failed']} 項，"
+              f"忙碌 {stage_summary['busy_seconds']} 秒 ({stage_summary['workers']} 個工作執行緒)")
+
+    # 管線依完成順序輸出，寫入前恢復來源 (Discord) 的順序，讓每次執行的行順序一致
+    source_order = {get_country_filename(attachment_filename): index
+                    for index, attachment_filename in enumerate(discord_images)}
+    written.sort(key=lambda task: source_order[task["filename"]])
+    for task in written:
+        row_data = build_row(task["filename"], task["properties"])
+        sheet_buffer.append(row_data)
+        print(f"  數據已加入寫入佇列: {row_data}")
+
+    if ocr_pool:
+        ocr_pool.close()
+
+    # 以單次 API 呼叫寫入本次執行的所有行 (配額錯誤由 sheetWriter 統一退避重試)
+    sheet_buffer.flush()
+
+    result_cache.save()
+    roi_cache.save()
+    for cache_label, cache in (("OCR 結果快取", result_cache), ("欄位指紋快取", roi_cache)):
+        cache_stats = cache.stats()
+        print(f"{cache_label}: 命中 {cache_stats['hits']} 次，未命中 {cache_stats['misses']} 次，共 {cache_stats['entries']} 筆")
+    set_value("result_cache", result_cache.stats())
+    set_value("roi_cache", roi_cache.stats())
+    set_value("images", {"received": len(discord_images), "written": len(written)})
+    return written
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
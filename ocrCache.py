@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# OCR 結果的本地快取
+# 大部分執行時國家狀態圖與上一次相同，直接以圖片內容的雜湊值查出上次的辨識結果
+OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', '.ocr_cache')
+RESULT_CACHE_FILE = os.path.join(OCR_CACHE_DIR, 'image_results.json')
+ROI_CACHE_FILE = os.path.join(OCR_CACHE_DIR, 'roi_fingerprints.json')
+
+def hash_bytes(data):
+    """返回資料的 SHA-256 十六進位字串，作為快取鍵。"""
+    return hashlib.sha256(data).hexdigest()
+
+def fingerprint_roi(roi_np):
+    """以裁切區域的尺寸與二值化像素計算指紋，像素完全相同的區域指紋才會相同。"""
+    roi_np = roi_np if roi_np.flags['C_CONTIGUOUS'] else roi_np.copy()
+    digest = hashlib.sha256(repr(roi_np.shape).encode())
+    digest.update(roi_np.tobytes())
+    return digest.hexdigest()
+
+def _load_json(path):
+    """讀取 JSON 快取檔，檔案不存在或損毀時返回空字典。"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"讀取快取檔 '{path}' 失敗，將重新建立: {e}")
+        return {}
+
+def _save_json(path, data):
+    """以先寫暫存檔再取代的方式寫入 JSON，避免中斷時留下損毀的快取檔。"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class ImageResultCache:
+    """以下載的圖片位元組雜湊為鍵，保存 getAllProperties 的屬性字典。
+
+    超過 max_age_seconds 的項目會過期；項目數超過 max_entries 時淘汰最久未使用的項目。
+    """
+
+    def __init__(self, path=RESULT_CACHE_FILE, max_entries=256, max_age_seconds=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = _load_json(path) # 雜湊 -> {"properties", "stored_at", "used_at"}
+        self._dirty = False
+        self._lock = threading.RLock() # 管線的多個階段會同時查詢與寫入
+        self._evict()
+
+    def get(self, image_bytes):
+        """查詢圖片的辨識結果，未命中或已過期時返回 None。"""
+        key = hash_bytes(image_bytes)
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.time()
+            if entry is None or now - entry["stored_at"] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["used_at"] = now
+            self._dirty = True
+            return dict(entry["properties"])
+
+    def put(self, image_bytes, properties):
+        """保存圖片的辨識結果。只快取所有欄位都成功辨識為整數的結果。"""
+        if not properties or not all(isinstance(value, int) for value in properties.values()):
+            return
+        key = hash_bytes(image_bytes)
+        with self._lock:
+            now = time.time()
+            self._entries[key] = {
+                "properties": dict(properties),
+                "stored_at": now,
+                "used_at": now,
+            }
+            self._dirty = True
+            self._evict()
+
+    def _evict(self):
+        """移除過期項目，並依最後使用時間淘汰超出容量的項目。"""
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry["stored_at"] > self.max_age_seconds]
+        for key in expired:
+            del self._entries[key]
+        overflow = len(self._entries) - self.max_entries
+        if overflow > 0:
+            oldest = sorted(self._entries, key=lambda key: self._entries[key]["used_at"])[:overflow]
+            for key in oldest:
+                del self._entries[key]
+        if expired or overflow > 0:
+            self._dirty = True
+
+    def save(self):
+        """將快取寫回磁碟 (沒有變更時不寫入)。"""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                _save_json(self.path, self._entries)
+                self._dirty = False
+            except OSError as e:
+                print(f"寫入快取檔 '{self.path}' 失敗: {e}")
+
+    def stats(self):
+        """返回命中/未命中次數與目前項目數。"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+class RoiFingerprintCache:
+    """以單一欄位裁切區域的像素指紋為鍵，保存辨識出的整數。
+
+    即使國家狀態圖有變動，通常也只有一兩個數值改變；像素完全相同的欄位直接返回上次的結果。
+    以 LRU 方式保留最多 max_entries 筆，並在執行之間持久化。
+    """
+
+    def __init__(self, path=ROI_CACHE_FILE, max_entries=4096):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # JSON 物件會保留順序，檔案中的順序即為最久未使用到最近使用
+        self._entries = OrderedDict(_load_json(path)) # 指紋 -> 整數
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._evict()
+
+    def get(self, roi_np):
+        """查詢裁切區域的辨識結果，未命中時返回 None。"""
+        key = fingerprint_roi(roi_np)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            self._dirty = True
+            return value
+
+    def put(self, roi_np, value):
+        """保存裁切區域的辨識結果。只快取成功辨識為整數的結果。"""
+        if not isinstance(value, int):
+            return
+        key = fingerprint_roi(roi_np)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._dirty = True
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的項目直到不超過容量。"""
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._dirty = True
+
+    def save(self):
+        """將快取寫回磁碟 (沒有變更時不寫入)。"""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                _save_json(self.path, self._entries)
+                self._dirty = False
+            except OSError as e:
+                print(f"寫入快取檔 '{self.path}' 失敗: {e}")
+
+    def stats(self):
+        """返回命中/未命中次數與目前項目數。"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+import cv2
+
+from runMetrics import incr, span
+
+# 整個行程共用的 EasyOCR Reader
+# 載入 torch 與模型權重很慢，因此延遲到第一次需要時才建立，並且只建立一次
+OCR_LANGUAGES = ['en']
+
+# 分級辨識: 先以原始解析度辨識，信心低於此值 (或無法轉為整數) 的欄位才放大後重新辨識
+OCR_MIN_CONFIDENCE = float(os.environ.get('OCR_MIN_CONFIDENCE', '0.6'))
+OCR_UPSCALE_FACTOR = 3
+
+_readers = {} # gpu 旗標 -> easyocr.Reader
+_load_seconds = {} # gpu 旗標 -> 載入耗時 (秒)
+_lock = threading.Lock()
+
+def get_reader(gpu=False):
+    """返回共用的 EasyOCR Reader，第一次呼叫時才載入。
+
+    多個執行緒同時呼叫時只會載入一次，其餘呼叫者會等待載入完成。
+    """
+    reader = _readers.get(gpu)
+    if reader is not None:
+        return reader
+    with _lock:
+        if gpu not in _readers:
+            print(f"正在載入 EasyOCR Reader (gpu={gpu})...")
+            start = time.perf_counter()
+            import easyocr # 延遲匯入，避免在不需要 OCR 時載入 torch
+            _readers[gpu] = easyocr.Reader(OCR_LANGUAGES, gpu=gpu)
+            _load_seconds[gpu] = time.perf_counter() - start
+            print(f"EasyOCR Reader 載入完成，耗時: {_load_seconds[gpu]:.2f}秒")
+        return _readers[gpu]
+
+def warm_up_reader(gpu=False, background=True):
+    """預先載入 Reader。
+
+    background=True 時在背景執行緒中載入並返回該執行緒，
+    讓載入與 Discord 抓取等網路操作同時進行；否則直接載入並返回 Reader。
+    """
+    if not background:
+        return get_reader(gpu)
+
+    def _warm_up():
+        try:
+            get_reader(gpu)
+        except Exception as e:
+            print(f"背景載入 EasyOCR Reader 時發生錯誤: {e}")
+
+    thread = threading.Thread(target=_warm_up, name="ocr-reader-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def get_reader_load_seconds(gpu=False):
+    """返回 Reader 的載入耗時 (秒)，尚未載入時返回 None。"""
+    return _load_seconds.get(gpu)
+
+def read_with_confidence(img_np, gpu=False, **kwargs):
+    """以 detail=1 辨識並合併所有文字片段。
+
+    返回:
+        tuple: (文字, 信心)；信心為各片段中最低者，沒有辨識到任何文字時為 0.0
+    """
+    results = get_reader(gpu).readtext(img_np, detail=1, paragraph=False, **kwargs)
+    if not results:
+        return "", 0.0
+    return "".join(text for _, text, _ in results), float(min(confidence for _, _, confidence in results))
+
+def is_confident(text, confidence):
+    """辨識結果的信心不低於 OCR_MIN_CONFIDENCE 且可以轉為整數時返回 True。"""
+    if confidence < OCR_MIN_CONFIDENCE:
+        return False
+    try:
+        int(text.strip())
+    except ValueError:
+        return False
+    return True
+
+def upscale(img_np, factor=OCR_UPSCALE_FACTOR):
+    """將裁切區域放大 factor 倍 (雙線性內插)。"""
+    return cv2.resize(img_np, dsize=(0, 0), fx=factor, fy=factor)
+
+def _read_pass(img_np, gpu, tier, field, span_attrs, kwargs):
+    with span("ocr.pass", field=field, tier=tier, **span_attrs) as current:
+        text, confidence = read_with_confidence(img_np, gpu, **kwargs)
+        current.set(confidence=round(confidence, 4))
+    return text, confidence
+
+def read_tiered(img_np, field=None, gpu=False, fast=None, span_attrs=None, **kwargs):
+    """分級辨識一個欄位。
+
+    先以原始解析度辨識；信心低於 OCR_MIN_CONFIDENCE 或無法轉為整數時才放大 OCR_UPSCALE_FACTOR 倍後重新辨識，
+    放大後的結果有信心或信心較高時採用放大後的結果。每次辨識的信心都記錄在 ocr.pass span (tier 為 fast 或 upscaled)。
+
+    參數:
+        fast: 已取得的快速辨識結果 (文字, 信心)，例如批次辨識的結果；提供時不再重複快速辨識
+        span_attrs: 附加到 ocr.pass span 的資訊 (例如裁切區域的座標)
+        其餘參數傳給 readtext (例如 allowlist)
+    返回:
+        tuple: (文字, 信心)
+    """
+    span_attrs = span_attrs or {}
+    text, confidence = fast if fast is not None else _read_pass(img_np, gpu, "fast", field, span_attrs, kwargs)
+    if is_confident(text, confidence):
+        return text, confidence
+    incr("ocr.upscaled") # 彙總中可直接看出有多少欄位走了較慢的放大辨識
+    upscaled_text, upscaled_confidence = _read_pass(upscale(img_np), gpu, "upscaled", field, span_attrs, kwargs)
+    if is_confident(upscaled_text, upscaled_confidence) or upscaled_confidence > confidence:
+        return upscaled_text, upscaled_confidence
+    return text, confidence
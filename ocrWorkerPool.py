@@ -0,0 +1,127 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# 多行程 OCR
+# 每個工作行程在啟動時載入一次 Reader 並保持常駐，各國家的辨識分散到多個核心同時進行。
+# 每個行程的 torch 執行緒數可設定，避免 (行程數 x 執行緒數) 超過核心數。
+
+OCR_TORCH_THREADS = int(os.environ.get('OCR_TORCH_THREADS', '1'))
+OCR_POOL_WORKERS = int(os.environ.get('OCR_POOL_WORKERS', '0')) # 0 表示依核心數自動決定
+
+def default_worker_count(torch_threads=OCR_TORCH_THREADS):
+    """依核心數與每個行程的 torch 執行緒數決定工作行程數。"""
+    return max(1, (os.cpu_count() or 1) // max(1, torch_threads))
+
+def _init_worker(torch_threads, gpu):
+    """工作行程初始化：限制 torch 執行緒數並預先載入 Reader。"""
+    os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
+    from ocrReader import get_reader
+    get_reader(gpu)
+
+def _ping():
+    return os.getpid()
+
+def _extract_properties(images):
+    """在工作行程中以不經文字偵測的批次辨識 main.py 的屬性 (欄位指紋快取由主行程查詢)。"""
+    from countryInfoExtractor import getAllPropertiesBatch
+    return getAllPropertiesBatch(images)
+
+def _get_state_status(state, content):
+    """在工作行程中辨識 tryChanSelfBot 的國家狀態。"""
+    from stateStatusExtractor import get_state_status
+    return get_state_status(state, content)
+
+
+class OcrWorkerPool:
+    """常駐的 OCR 工作行程池，結果依輸入 (國家) 順序返回。"""
+
+    def __init__(self, workers=None, torch_threads=OCR_TORCH_THREADS, gpu=False):
+        self.workers = workers or OCR_POOL_WORKERS or default_worker_count(torch_threads)
+        self.torch_threads = torch_threads
+        # 使用 spawn，避免在已載入 torch 的行程中 fork
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(torch_threads, gpu),
+        )
+        print(f"OCR 工作行程池: {self.workers} 個行程，每個行程 {torch_threads} 個 torch 執行緒")
+
+    def warm_up(self, background=False):
+        """啟動所有工作行程並等待它們載入 Reader。
+
+        background=True 時在背景執行緒中等待並返回該執行緒 (與 ocrReader.warm_up_reader 相同)，
+        讓工作行程載入 torch 與模型的同時可以進行 Discord 抓取等網路操作。
+        """
+        if background:
+            def _warm_up():
+                try:
+                    self.warm_up()
+                except Exception as e:
+                    print(f"背景啟動 OCR 工作行程時發生錯誤: {e}")
+
+            thread = threading.Thread(target=_warm_up, name="ocr-pool-warm-up", daemon=True)
+            thread.start()
+            return thread
+        futures = [self._executor.submit(_ping) for _ in range(self.workers)]
+        pids = {future.result() for future in futures}
+        print(f"OCR 工作行程已就緒: {len(pids)} 個行程")
+
+    def _gather_in_order(self, keys, futures, label):
+        """依輸入順序收集結果，單一項目失敗時記錄錯誤並返回 None。"""
+        results = {}
+        for key, future in zip(keys, futures):
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                print(f"  {label} {key} 時發生錯誤: {e}")
+                results[key] = None
+        return results
+
+    def extract_properties(self, images):
+        """將多張圖片平均分給各工作行程批次辨識。
+
+        參數:
+            images: dict，{名稱: binarize_rois 返回的 {屬性: 二值化陣列}} (可以只包含需要辨識的屬性)
+        返回:
+            dict: {名稱: getAllPropertiesBatch 的屬性字典或 None}，順序與輸入相同
+        """
+        keys = list(images)
+        chunks = [chunk for chunk in (keys[i::self.workers] for i in range(self.workers)) if chunk]
+        futures = [self._executor.submit(_extract_properties, {key: images[key] for key in chunk}) for chunk in chunks]
+        results = {}
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.update(future.result())
+            except Exception as e:
+                print(f"  辨識圖片 {', '.join(chunk)} 時發生錯誤: {e}")
+                results.update(dict.fromkeys(chunk))
+        return {key: results.get(key) for key in keys}
+
+    def get_state_statuses(self, images):
+        """平行執行多個國家的 get_state_status。
+
+        參數:
+            images: dict，{國家: 圖片內容 (bytes)}
+        返回:
+            dict: {國家: 狀態字典或 None}，順序與輸入相同
+        """
+        states = list(images)
+        futures = [self._executor.submit(_get_state_status, state, images[state]) for state in states]
+        return self._gather_in_order(states, futures, "讀取國家狀態")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
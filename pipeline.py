@@ -0,0 +1,131 @@
+import queue
+import threading
+import time
+
+# 以有界佇列串接的多階段處理管線
+# 每個階段有自己的工作執行緒數；佇列滿時上游會阻塞 (背壓)，
+# 讓各階段 (例如解碼與 OCR) 可以同時忙碌，整體延遲趨近於最慢的階段。
+
+PIPELINE_QUEUE_SIZE = 8 # 每個階段輸入佇列的容量
+
+_STOP = object() # 通知工作執行緒結束的標記
+
+
+class Stage:
+    """管線中的一個階段。
+
+    func 接收上一階段的輸出並返回要交給下一階段的項目；返回 None 表示丟棄該項目。
+    batch_size > 1 時，func 接收目前佇列中已就緒的最多 batch_size 個項目 (列表)，
+    並返回輸出項目的列表；上游較快時可以合併成批次處理 (例如批次 OCR)。
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=PIPELINE_QUEUE_SIZE, batch_size=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.batch_size = max(1, batch_size)
+        self.processed = 0 # 成功處理的項目數
+        self.failed = 0 # 拋出例外的項目數
+        self.busy_seconds = 0.0 # 所有工作執行緒花在 func 上的總時間
+
+
+class Pipeline:
+    """依序執行多個 Stage，每個階段之間以有界佇列連接。"""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.errors = [] # (階段名稱, 項目, 例外)
+
+    def run(self, items):
+        """將 items 逐一送入管線，等待全部處理完畢並返回最後一個階段的輸出列表。
+
+        items 可以是產生器 (例如邊下載邊產生的圖片)，會在呼叫端的執行緒中迭代。
+        """
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        outputs = []
+        lock = threading.Lock()
+
+        def emit(index, result):
+            if result is None:
+                return
+            if index + 1 < len(self.stages):
+                queues[index + 1].put(result) # 下一階段佇列滿時在此阻塞
+            else:
+                with lock:
+                    outputs.append(result)
+
+        def process(index, batch):
+            stage = self.stages[index]
+            start = time.perf_counter()
+            try:
+                result = stage.func(batch if stage.batch_size > 1 else batch[0])
+            except Exception as e:
+                with lock:
+                    stage.failed += len(batch)
+                    stage.busy_seconds += time.perf_counter() - start
+                    self.errors.extend((stage.name, item, e) for item in batch)
+                print(f"  管線階段 '{stage.name}' 處理時發生錯誤: {e}")
+                return
+            with lock:
+                stage.processed += len(batch)
+                stage.busy_seconds += time.perf_counter() - start
+            if stage.batch_size > 1:
+                for item in result or []:
+                    emit(index, item)
+            else:
+                emit(index, result)
+
+        def work(index):
+            stage = self.stages[index]
+            in_queue = queues[index]
+            stopping = False
+            while not stopping:
+                item = in_queue.get()
+                if item is _STOP:
+                    break
+                batch = [item]
+                # 取出佇列中已就緒的項目組成批次，不等待新項目
+                while len(batch) < stage.batch_size:
+                    try:
+                        item = in_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                process(index, batch)
+            with lock:
+                remaining[index] -= 1
+                last_worker = remaining[index] == 0
+            # 本階段最後一個工作執行緒結束時，通知下一階段的所有工作執行緒
+            if last_worker and index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1].workers):
+                    queues[index + 1].put(_STOP)
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for worker_id in range(stage.workers):
+                thread = threading.Thread(target=work, args=(index,), name=f"pipeline-{stage.name}-{worker_id}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                queues[0].put(item) # 第一階段佇列滿時在此阻塞
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_STOP)
+            for thread in threads:
+                thread.join()
+        return outputs
+
+    def summary(self):
+        """返回每個階段的處理數、失敗數與忙碌時間。"""
+        return [
+            {"stage": stage.name, "workers": stage.workers, "processed": stage.processed,
+             "failed": stage.failed, "busy_seconds": round(stage.busy_seconds, 3)}
+            for stage in self.stages
+        ]
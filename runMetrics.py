@@ -0,0 +1,171 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+# 執行過程的計時與計數
+# 以 span() 記錄每個階段 (登入、掃描、下載、二值化、各欄位 OCR、寫入) 的耗時與附加資訊，
+# 每次執行結束時以 JSON lines 附加到 RUN_REPORT_FILE: 每個 span 一行，最後一行是彙總。
+# 沒有進行中的執行 (start_run 之前) 時 span() 不做任何記錄。
+# 注意: OCR 工作行程池 (ocrWorkerPool) 的子行程中的 span 不會被記錄，只有呼叫端的總耗時。
+
+RUN_REPORT_FILE = os.environ.get('RUN_REPORT_FILE', 'run_report.jsonl')
+# 報告檔超過此大小時先改名為 <檔名>.1 (覆蓋上一份) 再寫入，避免常駐程式的報告無限增長；0 表示不限制
+RUN_REPORT_MAX_BYTES = int(os.environ.get('RUN_REPORT_MAX_BYTES', str(10 * 1024 * 1024)))
+
+_current = None # 進行中的 RunReport
+_current_lock = threading.Lock()
+
+
+class Span:
+    """一段計時區間；attrs 可在區間內以 set() 補上位元組數、筆數等資訊。"""
+
+    __slots__ = ("name", "attrs", "start", "duration")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.duration = None # 秒，區間結束後才有值
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class RunReport:
+    """一次執行的所有 span、計數器與數值。"""
+
+    def __init__(self, name):
+        self.name = name
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans = [] # (名稱, 相對開始時間, 耗時, 執行緒名稱, 附加資訊)
+        self.counters = defaultdict(int)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, duration, attrs):
+        with self._lock:
+            self.spans.append((name, start - self._start, duration, threading.current_thread().name, attrs))
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def set_value(self, name, value):
+        with self._lock:
+            self.values[name] = value
+
+    def summary(self):
+        """依 span 名稱彙總次數、總耗時與最大耗時 (毫秒)。"""
+        stages = {}
+        for name, _, duration, _, attrs in self.spans:
+            stage = stages.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0, "bytes": 0})
+            stage["count"] += 1
+            stage["total_ms"] += duration * 1000
+            stage["max_ms"] = max(stage["max_ms"], duration * 1000)
+            stage["errors"] += "error" in attrs
+            stage["bytes"] += attrs.get("bytes") or 0
+        for stage in stages.values():
+            stage["total_ms"] = round(stage["total_ms"], 3)
+            stage["max_ms"] = round(stage["max_ms"], 3)
+        return {
+            "type": "summary",
+            "run_id": self.run_id,
+            "run": self.name,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "duration_ms": round((time.perf_counter() - self._start) * 1000, 3),
+            "stages": stages,
+            "counters": dict(self.counters),
+            "values": self.values,
+        }
+
+    def write(self, path=RUN_REPORT_FILE):
+        """將所有 span 與彙總以 JSON lines 附加到 path，返回彙總。"""
+        summary = self.summary()
+        lines = [
+            json.dumps({
+                "type": "span", "run_id": self.run_id, "name": name,
+                "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3),
+                "thread": thread, **attrs,
+            }, ensure_ascii=False, default=str)
+            for name, start, duration, thread, attrs in self.spans
+        ]
+        lines.append(json.dumps(summary, ensure_ascii=False, default=str))
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _rotate_if_large(path)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        return summary
+
+
+def _rotate_if_large(path, max_bytes=RUN_REPORT_MAX_BYTES):
+    if not max_bytes:
+        return
+    try:
+        if os.path.getsize(path) >= max_bytes:
+            os.replace(path, f"{path}.1")
+    except (FileNotFoundError, ValueError):
+        pass # 檔案不存在 (或 os.devnull 等特殊路徑) 時直接附加
+
+
+def start_run(name):
+    """開始記錄一次執行，之後的 span 都會記錄到這份報告。"""
+    global _current
+    with _current_lock:
+        _current = RunReport(name)
+        return _current
+
+def finish_run(path=RUN_REPORT_FILE):
+    """結束目前的執行並寫出報告，返回彙總 (沒有進行中的執行時返回 None)。"""
+    global _current
+    with _current_lock:
+        report, _current = _current, None
+    if report is None:
+        return None
+    try:
+        return report.write(path)
+    except OSError as e:
+        print(f"寫入執行報告 '{path}' 失敗: {e}")
+        return report.summary()
+
+def current_run():
+    return _current
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """記錄一段區間的耗時；區間內拋出的例外會記錄在 error 欄位後繼續拋出。"""
+    current = Span(name, attrs)
+    current.start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        report = _current
+        if report is not None:
+            report.add_span(name, current.start, current.duration, attrs)
+
+def record_span(name, start, **attrs):
+    """記錄從 start (time.perf_counter()) 到現在的區間，用於無法以 with 包住的階段 (例如登入到 READY)。"""
+    report = _current
+    if report is not None:
+        report.add_span(name, start, time.perf_counter() - start, attrs)
+
+def incr(name, value=1):
+    report = _current
+    if report is not None:
+        report.incr(name, value)
+
+def set_value(name, value):
+    report = _current
+    if report is not None:
+        report.set_value(name, value)
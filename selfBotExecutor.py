@@ -1,13 +1,17 @@
 import asyncio
-import datetime
+import json
 import os
 import re
 import sys  # 引入 sys 模組用於 stdout flush
+import time
 
 import discord
 # from apscheduler.schedulers.asyncio import AsyncIOScheduler # 移除排程器導入
 from dotenv import load_dotenv  # 引入 load_dotenv
 
+from imageDownloader import MAX_IMAGE_BYTES
+from runMetrics import record_span, span
+
 load_dotenv()
 
 # 調試日誌開關
@@ -21,6 +25,8 @@ def log(message):
 
 USER_TOKEN = os.getenv('DISCORD_USER_TOKEN', 'DEFAULT_TOKEN')
 CHANNEL_ID = 1362649898977333360 
+# 常駐 discordWorker 的 Unix socket 路徑；設定且存在時 get_discord_images_sync 會優先使用
+DISCORD_WORKER_SOCKET = os.getenv('DISCORD_WORKER_SOCKET')
 
 # discord.py-self 不使用 Intents
 # intents = discord.Intents.default()
@@ -53,18 +59,116 @@ state_name = {
 # --- 移除佔位符函數結束 ---
 
 
+# 單一附件的大小上限，與 imageDownloader 一致
+MAX_ATTACHMENT_BYTES = MAX_IMAGE_BYTES
+
+# 歷史訊息掃描設定：每頁訊息數與最多往回翻的頁數
+HISTORY_PAGE_SIZE = int(os.getenv('DISCORD_HISTORY_PAGE_SIZE', '10'))
+HISTORY_MAX_PAGES = int(os.getenv('DISCORD_HISTORY_MAX_PAGES', '5'))
+# 記錄上次掃描位置的檔案
+SCAN_CURSOR_FILE = os.getenv('DISCORD_SCAN_CURSOR_FILE', '.discord_scan_cursor.json')
+
+
+class ScanCursor:
+    """持久化的掃描位置：最後處理的訊息 ID，以及每個國家最新圖片所在的訊息 ID。"""
+
+    def __init__(self, path=SCAN_CURSOR_FILE, last_message_id=None, latest=None):
+        self.path = path
+        self.last_message_id = last_message_id
+        self.latest = latest or {} # 附件檔名 -> 訊息 ID
+
+    @classmethod
+    def load(cls, path=SCAN_CURSOR_FILE):
+        """讀取掃描位置，檔案不存在或損毀時從頭開始。"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(path, data.get("last_message_id"), {k: int(v) for k, v in data.get("latest", {}).items()})
+        except FileNotFoundError:
+            return cls(path)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"讀取掃描位置 '{path}' 失敗，將重新掃描: {e}")
+            return cls(path)
+
+    def update(self, newest_message_id, found, gap=False):
+        """以本次掃描看到的最新訊息 ID 與找到的國家圖片更新位置。
+
+        gap=True 表示上次的位置與本次讀到的訊息之間還有沒讀取的訊息，
+        本次沒找到的國家不保留舊的訊息 ID (更新的圖片可能就在沒讀取的訊息中)。
+        """
+        if newest_message_id:
+            self.last_message_id = max(self.last_message_id or 0, newest_message_id)
+        if gap:
+            self.latest = {}
+        self.latest.update(found)
+
+    def save(self):
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"last_message_id": self.last_message_id, "latest": self.latest}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"寫入掃描位置 '{self.path}' 失敗: {e}")
+
+
+class HistoryPages:
+    """由新到舊逐頁讀取頻道的歷史訊息 (每頁 HISTORY_PAGE_SIZE 條，最多 HISTORY_MAX_PAGES 頁)。
+
+    以 async for 逐一產生 (頁碼, 訊息)；呼叫端找到需要的訊息後可直接 break。
+    讀完所有頁數後 truncated 為最後讀到的訊息 (到達頁數上限，還有更舊的訊息沒讀取)，否則為 None。
+    """
+
+    def __init__(self, channel, before=None, after=None):
+        self.channel = channel
+        self.before = before
+        self.after = after
+        self.truncated = None
+
+    async def __aiter__(self):
+        before = self.before
+        for page in range(HISTORY_MAX_PAGES):
+            messages = [message async for message in self.channel.history(
+                limit=HISTORY_PAGE_SIZE, before=before, after=self.after, oldest_first=False)]
+            for message in messages:
+                yield page, message
+            if len(messages) < HISTORY_PAGE_SIZE:
+                return # 已經沒有更多 (或更新的) 訊息
+            before = messages[-1]
+        self.truncated = before
+
+
+def report_missing_states(missing):
+    """列出在頁數上限內找不到圖片的國家 (國家名稱列表)。"""
+    if missing:
+        print(f"  在 {HISTORY_MAX_PAGES} 頁內找不到以下國家的圖片: {', '.join(missing)}")
+
+
 # --- 整合的 MyClient 類別 ---
 class MyClient(discord.Client):
-    def __init__(self):
+    def __init__(self, fetch_bytes=False, close_after_ready=True):
         # discord.py-self 不需要 intents 參數
         log("初始化 Discord 客戶端...")
         super().__init__()
+        # close_after_ready=False 時保持連線，由 discordWorker 按需呼叫 read_state_status
+        self.close_after_ready = close_after_ready
+        self._channel = None # 快取已取得的頻道物件，持續連線時不用每次重新查詢
+        self.scan_cursor = ScanCursor.load()
+        self._newest_message_id = None
         # self.scheduler = AsyncIOScheduler() # 移除排程器初始化
         # self.collected_urls = []  # 這個似乎是累積的，我們需要最近一次運行的
         self.last_run_urls = [] # 用於存儲最近一次 read_state_status 收集到的 URL
+        # fetch_bytes=True 時，在連線期間直接讀取附件內容 (簽名 URL 會過期)
+        self.fetch_bytes = fetch_bytes
+        self.last_run_images = {} # 附件檔名 -> 圖片內容
+        self._login_started = time.perf_counter()
 
     async def on_ready(self):
+        record_span("discord.login", self._login_started)
         log(f"Discord 客戶端已登入 - {self.user.name} ({self.user.id})")
+        if not self.close_after_ready:
+            log("on_ready: 持續連線模式，等待讀取請求")
+            return
         try:
             # 首次立即執行
             log("on_ready: 開始執行 read_state_status()...")
@@ -96,7 +200,9 @@ class MyClient(discord.Client):
         log("開始讀取狀態...")
         # 清空上次運行的結果
         self.last_run_urls = []
-        channel = self.get_channel(CHANNEL_ID) 
+        self.last_run_images = {}
+        read_tasks = {} # 附件檔名 -> 讀取附件內容的 Task，與掃描歷史訊息同時進行
+        channel = self._channel or self.get_channel(CHANNEL_ID)
 
         if not channel:
             print(f"錯誤：在 read_state_status 中找不到頻道 ID: {CHANNEL_ID}")
@@ -118,78 +224,132 @@ class MyClient(discord.Client):
         if not channel:
              print(f"錯誤：最終未能獲取頻道 {CHANNEL_ID}，無法讀取狀態。")
              return
+        self._channel = channel
 
         # state_list = [] # 似乎也不需要了，因為只收集 URL
         # image_urls_collected = [] # 不再需要本地變數，使用 self.last_run_urls
         try:
-            # 注意這裡的 limit=10，與您提供的程式碼一致
-            # 如果要抓取更多歷史，需要調整 limit，但風險隨之增加
-            log(f"開始從頻道 {channel.name} 抓取最近 10 條訊息...")
+            found = {} # 附件檔名 -> 訊息 ID (每個國家最新的一張)
+            self._newest_message_id = self.scan_cursor.last_message_id
             message_count = 0
-            async for message in channel.history(limit=10):
-                message_count += 1
-                log(f"處理第 {message_count} 條訊息 (ID: {message.id})...")
-                if message.attachments:
-                    try:
-                        url = message.attachments[0].url
-                        # 從 URL 提取檔名部分
-                        filename = url.split("/")[-1].split("?")[0]
-                        log(f"發現附件: {filename}")
-                        if filename in state_name:
-                            state = state_name[filename]
-                            log(f"識別為有效國家圖片: {state}")
-                            # --- 移除對 collect_image_url 的調用 ---
-                            # collect_image_url(url)
-                            # --- 移除對 collect_image_url 的調用結束 ---
-                            # state_list.append(state) # 不再需要 state 列表
-                            # 添加到當前運行的 URL 列表
-                            if url not in self.last_run_urls:
-                                self.last_run_urls.append(url)
-                                log(f"添加到本次運行列表，當前共 {len(self.last_run_urls)} 個URL")
-                            else:
-                                log(f"URL 已存在於本次運行列表中，跳過")
-                        else:
-                            # 僅在調試模式下輸出此信息，避免干擾
-                            log(f"  訊息 {message.id} 的附件檔名 {filename} 未在 state_name 中定義。")
-                    except IndexError:
-                         print(f"  訊息 {message.id} 的 attachments 列表為空。")
-                    except KeyError:
-                         # 如果 split 後的檔名不在 state_name 中
-                         filename_from_url = url.split("/")[-1].split("?")[0]
-                         print(f"  錯誤：檔名 '{filename_from_url}' 不在 state_name 字典中。URL: {url}")
-                    except Exception as e:
-                         print(f"  處理訊息 {message.id} 附件時發生錯誤: {e}")
+            scan_started = time.perf_counter()
+            gap_before = None # 新訊息超過頁數上限時，最後讀到的訊息 (與上次的位置之間還有沒讀取的訊息)
+
+            # 1. 只讀取上次掃描之後的新訊息 (由新到舊)，所有國家都找到時提早停止
+            if self.scan_cursor.last_message_id:
+                log(f"開始從頻道 {channel.name} 抓取訊息 {self.scan_cursor.last_message_id} 之後的新訊息...")
+                count, gap_before = await self._scan_history(
+                    channel, found, read_tasks, after=discord.Object(id=self.scan_cursor.last_message_id))
+                message_count += count
+
+            if gap_before is not None:
+                # 新訊息超過頁數上限，沒讀取的訊息中可能有更新的圖片，不能使用上次記錄的訊息位置；
+                # 從最後讀到的訊息繼續往回翻頁 (同樣受頁數上限限制)，仍未找到的國家視為找不到
+                log(f"上次掃描之後的新訊息超過 {HISTORY_MAX_PAGES} 頁，從訊息 {gap_before.id} 繼續往回翻頁...")
+                count, gap_before = await self._scan_history(channel, found, read_tasks, before=gap_before)
+                message_count += count
+            else:
+                # 2. 沒有新訊息的國家，直接從上次記錄的訊息位置讀取 (同一批發佈的圖片通常在同一頁)
+                known_ids = [message_id for filename, message_id in self.scan_cursor.latest.items()
+                             if filename in state_name and filename not in found]
+                if known_ids:
+                    log(f"{len(known_ids)} 個國家沒有新訊息，從上次記錄的訊息位置讀取...")
+                    count, _ = await self._scan_history(
+                        channel, found, read_tasks,
+                        before=discord.Object(id=max(known_ids) + 1), after=discord.Object(id=min(known_ids) - 1))
+                    message_count += count
+
+                # 3. 仍未找到的國家 (首次執行或記錄的訊息已刪除)，從最新訊息往回翻頁，直到頁數上限
+                if len(found) < len(state_name):
+                    log(f"開始從頻道 {channel.name} 最新訊息往回翻頁 (每頁 {HISTORY_PAGE_SIZE} 條，最多 {HISTORY_MAX_PAGES} 頁)...")
+                    count, _ = await self._scan_history(channel, found, read_tasks)
+                    message_count += count
+
+            report_missing_states([state for filename, state in state_name.items() if filename not in found])
+
+            # 記錄本次掃描的位置，下次只需要讀取更新的訊息
+            self.scan_cursor.update(self._newest_message_id, found, gap=gap_before is not None)
+            self.scan_cursor.save()
+            record_span("discord.history_scan", scan_started, messages=message_count, found=len(found))
 
             log(f"訊息處理完成，共處理 {message_count} 條訊息，找到 {len(self.last_run_urls)} 個有效國家圖片URL")
+            if read_tasks:
+                await self._collect_attachment_bytes(read_tasks)
             if not self.last_run_urls: # 檢查是否有收集到 URL
                 print("在此次抓取的訊息中未找到符合條件的 state 圖片 URL。")
                 return
 
-            # --- 移除不再需要的後續處理 ---
-            # # 這裡實際上我們只需要 URL，不需要處理圖片內容
-            # # 保留這段代碼只為了不破壞原有流程
-            # if not DEBUG_LOGS:
-            #     # 在非調試模式下，直接跳過圖片處理步驟
-            #     log("非調試模式，跳過圖片處理步驟，直接返回收集到的 URL")
-            #     return
-            #     
-            # unique_states = set(state_list) # 處理每個 state 一次
-            # log(f"處理 {len(unique_states)} 個不同的國家狀態")
-            # for state in unique_states:
-            #     try:
-            #         log(f"處理國家: {state}")
-            #         state_data = get_state_status(state) # 獲取狀態數據 (使用佔位符)
-            #         check_and_insert_state_data(state_data) # 檢查並插入數據 (使用佔位符)
-            #     except Exception as e:
-            #         print(f"處理 state '{state}' 時發生錯誤: {e}")
-            # 
-            # log("所有國家狀態處理完成")
-            # --- 移除不再需要的後續處理結束 ---
             log("read_state_status 完成 URL 收集。")
         except discord.Forbidden:
              print(f"錯誤：沒有權限讀取頻道 #{channel.name} 的歷史訊息。")
         except Exception as e:
              print(f"在 read_state_status 處理訊息時發生未預期錯誤: {e}")
+
+    async def _scan_history(self, channel, found, read_tasks, before=None, after=None):
+        """由新到舊逐頁讀取歷史訊息，所有國家都找到時提早停止。
+
+        返回:
+            tuple: (處理的訊息數, 到達頁數上限時最後讀到的訊息；讀完或提早停止時為 None)
+        """
+        message_count = 0
+        pages = HistoryPages(channel, before=before, after=after)
+        async for page, message in pages:
+            message_count += 1
+            log(f"處理第 {page + 1} 頁的訊息 (ID: {message.id})...")
+            self._newest_message_id = max(self._newest_message_id or 0, message.id)
+            self._handle_message(message, found, read_tasks)
+            if len(found) == len(state_name):
+                log("所有國家的圖片都已找到，提早停止掃描")
+                return message_count, None
+        return message_count, pages.truncated
+
+    def _handle_message(self, message, found, read_tasks):
+        """處理單一訊息的附件；每個國家只記錄最先遇到 (最新) 的一張。"""
+        if not message.attachments:
+            return
+        try:
+            attachment = message.attachments[0]
+            url = attachment.url
+            # 從 URL 提取檔名部分
+            filename = url.split("/")[-1].split("?")[0]
+            log(f"發現附件: {filename}")
+            if filename not in state_name:
+                # 僅在調試模式下輸出此信息，避免干擾
+                log(f"  訊息 {message.id} 的附件檔名 {filename} 未在 state_name 中定義。")
+                return
+            if filename in found:
+                log(f"{filename} 已有更新的圖片，跳過")
+                return
+            log(f"識別為有效國家圖片: {state_name[filename]}")
+            found[filename] = message.id
+            # 添加到當前運行的 URL 列表
+            self.last_run_urls.append(url)
+            log(f"添加到本次運行列表，當前共 {len(self.last_run_urls)} 個URL")
+            if self.fetch_bytes:
+                if attachment.size > MAX_ATTACHMENT_BYTES:
+                    print(f"  附件 {filename} 大小 {attachment.size} bytes 超過上限，跳過")
+                else:
+                    read_tasks[filename] = asyncio.create_task(self._read_attachment(filename, attachment))
+        except Exception as e:
+            print(f"  處理訊息 {message.id} 附件時發生錯誤: {e}")
+
+    async def _read_attachment(self, filename, attachment):
+        """讀取附件內容並記錄耗時與大小。"""
+        with span("discord.attachment_read", file=filename) as read_span:
+            content = await attachment.read()
+            read_span.set(bytes=len(content))
+        return content
+
+    async def _collect_attachment_bytes(self, read_tasks):
+        """等待所有附件讀取完成，將成功的內容存入 self.last_run_images。"""
+        filenames = list(read_tasks)
+        results = await asyncio.gather(*read_tasks.values(), return_exceptions=True)
+        for filename, result in zip(filenames, results):
+            if isinstance(result, Exception):
+                print(f"  讀取附件 {filename} 時發生錯誤: {result}")
+                continue
+            self.last_run_images[filename] = result
+        log(f"已讀取 {len(self.last_run_images)}/{len(filenames)} 個附件內容")
 # --- MyClient 類別結束 ---
 
 
@@ -210,22 +370,26 @@ def validate_token(token):
 
 
 # --- 提供給 main.py 調用的函數 ---
-async def fetch_images_from_discord():
+async def fetch_images_from_discord(fetch_bytes=False):
     """供 main.py 調用的函數，用於獲取 Discord 頻道中的圖片 URL。
     
+    參數:
+        fetch_bytes: 為 True 時在連線期間讀取附件內容並返回
     返回:
         list: 一個包含最近一次運行收集到的圖片 URL 的列表
+        dict: fetch_bytes=True 時，返回 {附件檔名: 圖片內容}
     """
     log("開始從 Discord 獲取圖片 URL...")
+    empty_result = {} if fetch_bytes else []
     
     # 驗證 Token
     is_valid, validation_message = validate_token(USER_TOKEN)
     if not is_valid:
         print(f"TOKEN 錯誤: {validation_message}")
         print("請在 .env 文件中設置有效的 DISCORD_USER_TOKEN")
-        return []
+        return empty_result
 
-    client = MyClient()
+    client = MyClient(fetch_bytes=fetch_bytes)
     returned_urls = []  # 創建一個本地變數來存儲最終要返回的 URL
     
     try:
@@ -243,13 +407,18 @@ async def fetch_images_from_discord():
         # 為了診斷，列出所有收集到的 URL
         for i, url in enumerate(returned_urls, 1):
             log(f"  URL {i}: {url}")
+
+        if fetch_bytes:
+            returned_images = dict(client.last_run_images)
+            log(f"從 Discord 獲取完成，返回 {len(returned_images)} 張圖片的內容")
+            return returned_images
             
     except Exception as e:
         print(f"啟動或運行 Discord 客戶端時發生錯誤: {e}")
         # 打印詳細錯誤以便調試
         import traceback
         traceback.print_exc()
-        return []
+        return empty_result
         
     finally:
         # 注意：client.close() 在 on_ready 中被調用了。
@@ -263,52 +432,83 @@ async def fetch_images_from_discord():
 
 
 # --- 簡化版本的 main 函數，只用於獲取圖片 URL ---
-async def get_discord_images():
-    """簡化版本的 main 函數，只用於獲取圖片 URL，不執行排程任務"""
+async def get_discord_images(fetch_bytes=False):
+    """簡化版本的 main 函數，只用於獲取圖片 URL (或圖片內容)，不執行排程任務"""
     log("執行 get_discord_images()...")
     
     log("調用 fetch_images_from_discord()...")
-    start_time = datetime.datetime.now()
-    urls = await fetch_images_from_discord()
-    end_time = datetime.datetime.now()
-    log(f"fetch_images_from_discord() 完成，耗時: {(end_time-start_time).total_seconds()}秒")
+    with span("discord.fetch", fetch_bytes=fetch_bytes) as fetch_span:
+        urls = await fetch_images_from_discord(fetch_bytes=fetch_bytes)
+    log(f"fetch_images_from_discord() 完成，耗時: {fetch_span.duration:.3f}秒")
     
     log(f"get_discord_images() 完成，返回 {len(urls)} 個 URL")
     return urls
 
 
 # --- 供外部調用的同步函數 ---
-def get_discord_images_sync():
+def get_discord_images_sync(fetch_bytes=False):
     """供外部調用的同步函數，用於獲取 Discord 頻道中的圖片 URL
     
+    參數:
+        fetch_bytes: 為 True 時在 Discord 連線期間直接讀取附件內容，
+                     返回 {附件檔名: 圖片內容}，不需要之後再以會過期的 URL 下載
     返回:
         tuple: (成功狀態, list) - (成功狀態表示是否成功連接 Discord 並獲取數據, URLs列表)
+               fetch_bytes=True 時第二項為 dict
     """
     log("開始執行 get_discord_images_sync()...")
+    empty_result = {} if fetch_bytes else []
+
+    # 若有常駐的 discordWorker，直接向它請求，省去每次登入 Discord 的時間
+    if DISCORD_WORKER_SOCKET and os.path.exists(DISCORD_WORKER_SOCKET):
+        try:
+            from discordWorker import request_images_from_worker  # 延遲匯入，避免循環匯入
+            with span("discord.worker_request", fetch_bytes=fetch_bytes) as request_span:
+                result = request_images_from_worker(DISCORD_WORKER_SOCKET, fetch_bytes=fetch_bytes)
+                request_span.set(items=len(result))
+            if result:
+                log(f"從常駐 Discord worker 獲取了 {len(result)} 項結果")
+                return True, result
+            print("常駐 Discord worker 未返回任何圖片，改用一次性登入")
+        except Exception as e:
+            print(f"向常駐 Discord worker 請求時發生錯誤，改用一次性登入: {e}")
+
     try:
         log("調用 asyncio.run() 執行異步函數...")
-        start_time = datetime.datetime.now()
+        start_time = time.perf_counter()
         
         # 設置超時時間，防止永久阻塞
-        urls = asyncio.run(asyncio.wait_for(get_discord_images(), timeout=60.0))
+        urls = asyncio.run(asyncio.wait_for(get_discord_images(fetch_bytes=fetch_bytes), timeout=60.0))
         
-        end_time = datetime.datetime.now()
-        log(f"異步函數執行完成，耗時: {(end_time-start_time).total_seconds()}秒")
+        log(f"異步函數執行完成，耗時: {time.perf_counter() - start_time:.3f}秒")
         
         if urls:
             log(f"成功獲取 {len(urls)} 個 URL")
             return True, urls
         else:
             print("從 Discord 獲取圖片 URL 失敗：未找到符合條件的圖片")
-            return False, []
+            return False, empty_result
     except asyncio.TimeoutError:
         print("從 Discord 獲取圖片 URL 超時（執行超過60秒）")
-        return False, []
+        return False, empty_result
     except Exception as e:
         print(f"從 Discord 獲取圖片 URL 時發生錯誤: {e}")
         import traceback
         traceback.print_exc()  # 打印詳細的錯誤棧
-        return False, []
+        return False, empty_result
+
+
+class DiscordImageSource:
+    """main.main 的預設圖片來源：在 Discord 連線期間讀取各國家最新的附件內容。
+
+    其他來源 (例如 localStandIns.SyntheticImageSource) 只需要提供相同的 name 與 fetch()。
+    """
+
+    name = "Discord"
+
+    def fetch(self):
+        """返回 (成功, {附件檔名: 圖片內容})。"""
+        return get_discord_images_sync(fetch_bytes=True)
 
 
 # --- 移除不再需要的 get_country_image_urls ---
@@ -0,0 +1,67 @@
+import random
+import time
+
+import gspread
+
+from runMetrics import incr, span
+
+# 批次寫入 Google Sheets
+# 一次執行的所有行先暫存起來，再以單次 append_rows 寫入，避免逐行呼叫 API 並 sleep
+
+SHEET_HEADER = ["國家", "軍事", "商業", "科技", "文化", "更新時間"] # 工作表第一行的標頭
+SHEET_FLUSH_SIZE = 100 # 暫存行數達到此值時自動寫入 (一次執行通常只會在結束時寫入一次)
+QUOTA_MAX_RETRIES = 5 # 配額或暫時性錯誤的最大重試次數
+QUOTA_BASE_DELAY = 2.0 # 指數退避的起始等待秒數
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def call_with_backoff(func, *args, max_retries=None, base_delay=None, **kwargs):
+    """呼叫 Sheets API，遇到配額 (429) 或暫時性伺服器錯誤時以指數退避重試。
+
+    max_retries / base_delay 未指定時使用呼叫當下的 QUOTA_MAX_RETRIES / QUOTA_BASE_DELAY (負載測試會調低)。
+    """
+    max_retries = QUOTA_MAX_RETRIES if max_retries is None else max_retries
+    base_delay = QUOTA_BASE_DELAY if base_delay is None else base_delay
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status_code = getattr(e.response, 'status_code', None)
+            if status_code not in RETRYABLE_STATUS_CODES or attempt == max_retries:
+                raise
+            delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
+            print(f"  Google Sheets API 錯誤 ({status_code})，{delay:.1f} 秒後重試 ({attempt + 1}/{max_retries})...")
+            incr("sheet.retries")
+            time.sleep(delay)
+
+
+class SheetRowBuffer:
+    """暫存要附加到工作表的行，並以批次方式寫入。"""
+
+    def __init__(self, worksheet, flush_size=SHEET_FLUSH_SIZE, value_input_option='USER_ENTERED'):
+        self.worksheet = worksheet
+        self.flush_size = flush_size
+        self.value_input_option = value_input_option
+        self.rows = []
+        self.written_rows = 0
+
+    def append(self, row_data):
+        """加入一行，暫存行數達到 flush_size 時自動寫入。"""
+        self.rows.append(row_data)
+        if self.flush_size and len(self.rows) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """將所有暫存的行以單次 API 呼叫寫入工作表，返回寫入的行數。"""
+        if not self.rows:
+            return 0
+        rows, self.rows = self.rows, []
+        try:
+            with span("sheet.append_rows", rows=len(rows)):
+                call_with_backoff(self.worksheet.append_rows, rows, value_input_option=self.value_input_option)
+        except Exception:
+            # 寫入失敗時保留資料，讓呼叫端可以決定是否再次 flush
+            self.rows = rows + self.rows
+            raise
+        self.written_rows += len(rows)
+        print(f"  已批次寫入 {len(rows)} 行到 Google Sheet")
+        return len(rows)
@@ -0,0 +1,121 @@
+import argparse
+import json
+import unicodedata
+
+from stateStore import (DB_PATH, STAT_KEYS, VALUE_COLUMNS, SchemaOutdatedError, connect, connect_read_only, read_latest_rows,
+                        read_value_at)
+
+# 查詢 tryChanSelfBot 記錄的國家狀態
+#   python stateQuery.py latest
+#   python stateQuery.py growth --hours 24 [--state 夏國]
+#   python stateQuery.py leaderboard --stat military [--limit 3]
+#   python stateQuery.py migrate  (將舊資料庫更新到最新結構，唯一會寫入的指令)
+# 加上 --json 輸出 JSON。每個國家只做固定次數的索引查找，查詢時間不隨歷史資料量增加。
+# 以唯讀連線開啟資料庫，不套用遷移也不寫入 (可以查詢唯讀的複本)。
+
+LEADERBOARD_STATS = VALUE_COLUMNS
+
+
+def query_latest(conn):
+    """每個國家的最新一筆。"""
+    return [
+        {"state": row["state"], **{column: row[column] for column in VALUE_COLUMNS}, "updated_at": row["updated_at"]}
+        for row in read_latest_rows(conn)
+    ]
+
+def query_growth(conn, hours, states=None):
+    """每個國家在最近 hours 小時內各項數值的增量與每小時增長率。"""
+    (since,) = conn.execute("SELECT datetime('now', ?)", (f"-{hours} hours",)).fetchone()
+    latest_rows = {row["state"]: row for row in read_latest_rows(conn)}
+    results = []
+    for state in states or latest_rows:
+        latest = latest_rows.get(state)
+        if latest is None:
+            continue
+        before = read_value_at(conn, state, since)
+        if before is None:
+            continue # 這段期間之前沒有資料，無法計算增長
+        (elapsed_hours,) = conn.execute(
+            "SELECT (julianday(?) - julianday(?)) * 24", (latest["updated_at"], before["updated_at"])
+        ).fetchone()
+        entry = {"state": state, "since": before["updated_at"], "until": latest["updated_at"]}
+        for column in ["activity", "influence"] + STAT_KEYS:
+            if latest[column] is None or before[column] is None:
+                entry[column] = entry[f"{column}_per_hour"] = None
+                continue
+            delta = latest[column] - before[column]
+            entry[column] = delta
+            entry[f"{column}_per_hour"] = round(delta / elapsed_hours, 2) if elapsed_hours > 0 else None
+        results.append(entry)
+    return results
+
+def query_leaderboard(conn, stat, limit=None):
+    """依某項數值的最新值排序的排行榜。"""
+    rows = [row for row in query_latest(conn) if row[stat] is not None]
+    rows.sort(key=lambda row: row[stat], reverse=True)
+    return [
+        {"rank": rank, "state": row["state"], stat: row[stat], "updated_at": row["updated_at"]}
+        for rank, row in enumerate(rows[:limit], start=1)
+    ]
+
+
+def _display_width(text):
+    # 中文字在終端機中佔兩格
+    return sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+
+def format_table(rows):
+    """將字典列表格式化為對齊的文字表格。"""
+    if not rows:
+        return "(沒有資料)"
+    columns = list(rows[0])
+    cells = [[str(column) for column in columns]] + [["" if row[column] is None else str(row[column]) for column in columns] for row in rows]
+    widths = [max(_display_width(line[i]) for line in cells) for i in range(len(columns))]
+    lines = []
+    for index, line in enumerate(cells):
+        lines.append("  ".join(cell + " " * (width - _display_width(cell)) for cell, width in zip(line, widths)).rstrip())
+        if index == 0:
+            lines.append("  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="查詢記錄的國家狀態")
+    parser.add_argument("--db", default=DB_PATH, help="資料庫路徑")
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("latest", help="所有國家的最新狀態")
+    growth_parser = subparsers.add_parser("growth", help="最近 N 小時的增長")
+    growth_parser.add_argument("--hours", type=float, default=24)
+    growth_parser.add_argument("--state", action="append", help="只查詢指定國家 (可重複)")
+    leaderboard_parser = subparsers.add_parser("leaderboard", help="某項數值的排行榜")
+    leaderboard_parser.add_argument("--stat", choices=LEADERBOARD_STATS, default="military")
+    leaderboard_parser.add_argument("--limit", type=int)
+    subparsers.add_parser("migrate", help="將資料庫更新到最新結構")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        connect(args.db).close()
+        print(f"資料庫 {args.db} 已是最新結構")
+        return
+    try:
+        conn = connect_read_only(args.db)
+    except (FileNotFoundError, SchemaOutdatedError) as e:
+        parser.exit(1, f"{e}\n")
+    try:
+        if args.command == "latest":
+            rows = query_latest(conn)
+        elif args.command == "growth":
+            rows = query_growth(conn, args.hours, args.state)
+        else:
+            rows = query_leaderboard(conn, args.stat, args.limit)
+    finally:
+        conn.close()
+
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print(format_table(rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from imagePreprocessor import binarize_any_channel, decode_image
+from ocrReader import read_tiered
+from runMetrics import span
+
+# tryChanSelfBot 使用的國家狀態辨識 (活動值、影響力、各項數值與等級)
+# 獨立成模組，讓 OCR 工作行程可以匯入而不會啟動 Discord 客戶端
+
+# 與 main.py 共用 ocrReader 的 Reader，第一次辨識時才載入
+OCR_USE_GPU = True
+
+# 設定目錄後，每次辨識都會把原始圖片 ({國家}.png) 與二值化結果 (_{國家}_gray.png) 寫到該目錄以便除錯
+# 寫入在背景執行緒中進行；未設定時辨識過程完全不讀寫磁碟
+# (tryChanSelfBot 在也未設定 BOT_RUN_REPORT 時，每次讀取只有 SQLite 會寫入磁碟)
+STATE_DEBUG_DUMP_DIR = os.getenv("STATE_DEBUG_DUMP_DIR", "")
+
+_dump_executor = None # 延遲建立的背景寫入執行緒
+
+# 忽略特定內容的 warning（pin_memory on MPS）
+warnings.filterwarnings("ignore", message="'pin_memory' argument is set as true but not supported on MPS")
+
+
+def extract_number_from_region(img, x, y, dx, dy, field=None):
+    # 擷取 ROI 區域
+    roi = img[y:y+dy, x:x+dx]
+
+    # # 放大 3 倍
+    # large_img = cv2.resize(roi, dsize=(0, 0), fx=3, fy=3)
+
+    # # 二值化
+    # _, thresh = cv2.threshold(large_img, 150, 255, cv2.THRESH_BINARY)
+
+    # # 先腐蝕再膨脹（幫助字元分離）
+    # kernel = np.ones((2, 2), np.uint8)
+    # processed = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
+
+    # # OCR 辨識（只允許數字、使用單行模式）
+    # config = '--psm 7 -c tessedit_char_whitelist=0123456789'
+    # text = pytesseract.image_to_string(processed, config=config).strip()
+
+    # 使用 EasyOCR 分級辨識：先以原始解析度辨識，信心不足或無法轉為整數時才放大 3 倍後重新辨識
+    text, _ = read_tiered(roi, field, OCR_USE_GPU, span_attrs={"x": x, "y": y})
+    return text
+
+
+def _write_debug_images(state, content, img):
+    try:
+        os.makedirs(STATE_DEBUG_DUMP_DIR, exist_ok=True)
+        with open(os.path.join(STATE_DEBUG_DUMP_DIR, f"{state}.png"), "wb") as f:
+            f.write(content)
+        cv2.imwrite(os.path.join(STATE_DEBUG_DUMP_DIR, f"_{state}_gray.png"), img)
+    except Exception as e:
+        print(f"寫入 {state} 的除錯圖片時發生錯誤: {e}")
+
+
+def dump_debug_images(state, content, img):
+    """在背景執行緒中寫出原始圖片與二值化結果 (只有設定 STATE_DEBUG_DUMP_DIR 時)。"""
+    global _dump_executor
+    if not STATE_DEBUG_DUMP_DIR:
+        return
+    if _dump_executor is None:
+        _dump_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-debug-dump")
+    _dump_executor.submit(_write_debug_images, state, content, img)
+
+
+def get_state_status(state: str, content: bytes):
+    """從下載的國家狀態圖 (圖片內容) 辨識各項數值，圖片只在記憶體中解碼。"""
+    # 任一通道 >= 150 為白色，其餘為黑色
+    with span("binarize", state=state, bytes=len(content)):
+        img = binarize_any_channel(decode_image(content))
+    dump_debug_images(state, content, img)
+    # 讀取圖片
+    activity = extract_number_from_region(img, 483, 100, 107, 36, "activity")
+    military = extract_number_from_region(img, 485, 161, 106, 46, "military")
+    military_lv = extract_number_from_region(img, 685, 161, 48, 46, "military_lv")
+    trade = extract_number_from_region(img, 485, 224, 106, 46, "trade")
+    trade_lv = extract_number_from_region(img, 685, 224, 48, 46, "trade_lv")
+    tech = extract_number_from_region(img, 485, 287, 106, 46, "tech")
+    tech_lv = extract_number_from_region(img, 685, 287, 48, 46, "tech_lv")
+    culture = extract_number_from_region(img, 485, 349, 106, 46, "culture")
+    culture_lv = extract_number_from_region(img, 685, 349, 48, 46, "culture_lv")
+    influence = extract_number_from_region(img, 85, 288, 52, 50, "influence")
+
+    return {
+        "state": state,
+        "activity": int(activity),
+        "influence": int(influence),
+        "military": int(military),
+        "military_lv": int(military_lv),
+        "trade": int(trade),
+        "trade_lv": int(trade_lv),
+        "tech": int(tech),
+        "tech_lv": int(tech_lv),
+        "culture": int(culture),
+        "culture_lv": int(culture_lv)
+    }
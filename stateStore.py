@@ -0,0 +1,463 @@
+import os
+import sqlite3
+import urllib.parse
+
+from runMetrics import span
+
+# tryChanSelfBot 的國家狀態資料庫
+# 以 PRAGMA user_version 記錄結構版本並依序套用遷移，
+# 使用 WAL 日誌模式，每次排程的所有寫入在同一個交易中以 executemany 完成。
+# 原始資料只保留 RAW_RETENTION_HOURS，較舊的資料彙整到每小時與每日的彙總表 (min/max/last)。
+
+DB_PATH = os.getenv("STATE_DB_PATH", "my_database.db")
+RAW_RETENTION_HOURS = int(os.getenv("STATE_RAW_RETENTION_HOURS", str(7 * 24))) # 原始資料保留時數
+ROLLUP_BATCH_SIZE = 10000 # 每次彙整從原始資料讀取的筆數
+PRUNE_BATCH_SIZE = 10000 # 每個交易刪除的原始資料筆數
+
+STAT_KEYS = ["military", "trade", "tech", "culture"] # 有數值與等級的四項屬性
+STATE_COLUMNS = [
+    "state", "activity", "influence",
+    "military", "military_lv", "trade", "trade_lv",
+    "tech", "tech_lv", "culture", "culture_lv",
+]
+VALUE_COLUMNS = STATE_COLUMNS[1:] # 彙總表中記錄 min/max/last 的數值欄位
+
+# 彙總的時間粒度: (資料表, 保留 updated_at 的前綴長度, 補上的後綴)
+# updated_at 是 SQLite CURRENT_TIMESTAMP 的 UTC 'YYYY-MM-DD HH:MM:SS'，切字串就能得到區間起點
+ROLLUPS = {
+    "hourly": ("state_rollup_hourly", 13, ":00:00"),
+    "daily": ("state_rollup_daily", 10, " 00:00:00"),
+}
+
+def _rollup_table_sql(table):
+    value_columns = ",\n".join(
+        f"            {column}_min INTEGER, {column}_max INTEGER, {column}_last INTEGER" for column in VALUE_COLUMNS
+    )
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            state TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            samples INTEGER NOT NULL,
+            last_at DATETIME NOT NULL,
+{value_columns},
+            PRIMARY KEY (state, bucket)
+        ) WITHOUT ROWID
+    """
+
+# 依版本排列的遷移，每個版本是一組 SQL 語句；只能在尾端新增，不可修改已發佈的版本
+MIGRATIONS = [
+    # 1: 原本 tryChanSelfBot 建立的資料表
+    [
+        """
+        CREATE TABLE IF NOT EXISTS state_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            state TEXT,
+            activity INTEGER,
+            military INTEGER,
+            trade INTEGER,
+            tech INTEGER,
+            culture INTEGER,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    # 2: 補上 INSERT 一直在寫入、但資料表沒有的影響力與等級欄位
+    [
+        "ALTER TABLE state_data ADD COLUMN influence INTEGER",
+        "ALTER TABLE state_data ADD COLUMN military_lv INTEGER",
+        "ALTER TABLE state_data ADD COLUMN trade_lv INTEGER",
+        "ALTER TABLE state_data ADD COLUMN tech_lv INTEGER",
+        "ALTER TABLE state_data ADD COLUMN culture_lv INTEGER",
+    ],
+    # 3: 讓「某國家的最新一筆」只需要一次索引查找
+    [
+        "CREATE INDEX IF NOT EXISTS idx_state_data_state_updated_at ON state_data (state, updated_at)",
+    ],
+    # 4: 每小時與每日的彙總表，以及記錄已彙整到哪一筆原始資料的進度表
+    [
+        _rollup_table_sql("state_rollup_hourly"),
+        _rollup_table_sql("state_rollup_daily"),
+        """
+        CREATE TABLE IF NOT EXISTS rollup_progress (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        )
+        """,
+    ],
+]
+
+_INSERT_SQL = f"""
+    INSERT INTO state_data ({", ".join(STATE_COLUMNS)})
+    VALUES ({", ".join("?" for _ in STATE_COLUMNS)})
+"""
+
+# 同一秒內寫入的資料 updated_at 相同，以 id 決定先後 (id 是 rowid，已包含在索引中)
+_LATEST_SQL = """
+    SELECT *
+    FROM state_data
+    WHERE state = ?
+    ORDER BY updated_at DESC, id DESC
+    LIMIT 1
+"""
+
+# 以索引逐一跳到下一個國家名稱，不必掃描整個資料表就能列出所有國家
+_STATES_SQL = """
+    WITH RECURSIVE states(state) AS (
+        SELECT MIN(state) FROM state_data
+        UNION ALL
+        SELECT (SELECT MIN(state) FROM state_data WHERE state > states.state)
+        FROM states
+        WHERE states.state IS NOT NULL
+    )
+    SELECT state FROM states WHERE state IS NOT NULL
+"""
+
+
+def _rollup_upsert_sql(table):
+    columns = ["state", "bucket", "samples", "last_at"]
+    updates = ["samples = samples + excluded.samples", "last_at = excluded.last_at"]
+    for column in VALUE_COLUMNS:
+        columns += [f"{column}_min", f"{column}_max", f"{column}_last"]
+        # 舊資料的欄位可能是 NULL，SQLite 的 MIN/MAX 只要有一個 NULL 就返回 NULL
+        updates += [
+            f"{column}_min = COALESCE(MIN({column}_min, excluded.{column}_min), {column}_min, excluded.{column}_min)",
+            f"{column}_max = COALESCE(MAX({column}_max, excluded.{column}_max), {column}_max, excluded.{column}_max)",
+            f"{column}_last = COALESCE(excluded.{column}_last, {column}_last)",
+        ]
+    return f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        VALUES ({", ".join("?" for _ in columns)})
+        ON CONFLICT (state, bucket) DO UPDATE SET {", ".join(updates)}
+    """
+
+_ROLLUP_UPSERT_SQL = {name: _rollup_upsert_sql(table) for name, (table, _, _) in ROLLUPS.items()}
+
+
+class SchemaOutdatedError(RuntimeError):
+    """唯讀開啟的資料庫尚未套用所有遷移時拋出 (唯讀連線無法更新結構)。"""
+
+
+def connect(path=DB_PATH):
+    """開啟資料庫、設定 WAL 並套用尚未執行的遷移。"""
+    # isolation_level=None: 由 StateStore 自行以 BEGIN/COMMIT 控制交易
+    # check_same_thread=False: 連線可以在建立它以外的執行緒使用，由呼叫端確保同一時間只有一個執行緒使用
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL") # WAL 下每次 COMMIT 不必 fsync，斷電最多遺失最後幾筆
+    migrate(conn)
+    return conn
+
+def connect_read_only(path=DB_PATH):
+    """以唯讀模式開啟資料庫，不套用遷移也不變更日誌模式 (供 stateQuery 等查詢工具使用)。
+
+    結構版本低於最新版本時拋出 SchemaOutdatedError。
+
+    WAL 資料庫在無法建立 -shm 檔的位置 (例如唯讀的複本) 無法以 mode=ro 讀取，
+    此時改用 immutable=1 (假設讀取期間沒有其他行程寫入)。
+    """
+    uri = f"file:{urllib.parse.quote(os.path.abspath(path))}"
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"找不到資料庫: {path}")
+    conn = sqlite3.connect(f"{uri}?mode=ro", uri=True)
+    try:
+        conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+    except sqlite3.OperationalError:
+        conn.close()
+        conn = sqlite3.connect(f"{uri}?mode=ro&immutable=1", uri=True)
+    conn.row_factory = sqlite3.Row
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(MIGRATIONS):
+        conn.close()
+        raise SchemaOutdatedError(
+            f"資料庫 {path} 的結構版本為 {version}，需要版本 {len(MIGRATIONS)}；"
+            f"請先執行 tryChanSelfBot 或 python stateQuery.py --db {path} migrate 更新結構")
+    return conn
+
+def migrate(conn):
+    """依 user_version 套用遷移，每個版本在自己的交易中完成，返回遷移後的版本。"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                _execute_migration(conn, statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        print(f"資料庫結構已更新到版本 {target}")
+    return max(version, len(MIGRATIONS))
+
+def _execute_migration(conn, statement):
+    try:
+        conn.execute(statement)
+    except sqlite3.OperationalError as e:
+        # 手動修改過的資料庫可能已經有這個欄位
+        if "duplicate column name" not in str(e):
+            raise
+
+def read_states(conn):
+    """返回資料庫中所有國家的名稱 (以索引跳躍，不掃描資料表)。"""
+    return [state for (state,) in conn.execute(_STATES_SQL).fetchall()]
+
+def read_latest_rows(conn):
+    """返回每個國家的最新一筆 (包含 updated_at)。"""
+    return [conn.execute(_LATEST_SQL, (state,)).fetchone() for state in read_states(conn)]
+
+def read_value_at(conn, state, at):
+    """返回某國家在 UTC 時間 at 當下的讀數 (at 之前的最後一筆)，沒有資料時返回 None。
+
+    原始資料已被刪除時改讀每小時、再改讀每日彙總表的 last 值；每次都是一次索引查找。
+    返回的字典包含 VALUE_COLUMNS 與 updated_at (彙總資料為該區間最後一筆的時間)。
+    """
+    row = conn.execute("""
+        SELECT * FROM state_data
+        WHERE state = ? AND updated_at <= ?
+        ORDER BY updated_at DESC, id DESC
+        LIMIT 1
+    """, (state, at)).fetchone()
+    if row is not None:
+        return {**{column: row[column] for column in VALUE_COLUMNS}, "updated_at": row["updated_at"]}
+    for table, _, _ in ROLLUPS.values():
+        row = conn.execute(f"""
+            SELECT * FROM {table}
+            WHERE state = ? AND bucket <= ? AND last_at <= ?
+            ORDER BY bucket DESC
+            LIMIT 1
+        """, (state, at, at)).fetchone()
+        if row is not None:
+            return {**{column: row[f"{column}_last"] for column in VALUE_COLUMNS}, "updated_at": row["last_at"]}
+    return None
+
+def has_grown(latest, state_data):
+    """比較最新一筆與新讀數，任一項在合理範圍內增長時返回 True。
+
+    增幅過大的讀數視為 OCR 誤讀而忽略。latest 缺少某欄位 (遷移前的舊資料) 時視為需要寫入，
+    讓新欄位有基準值。
+    """
+    if any(latest[key] is None for key in STATE_COLUMNS):
+        return True
+    for key in STAT_KEYS:
+        if latest[key] < state_data[key] and state_data[key] - latest[key] < 1000:
+            return True
+        elif latest[f"{key}_lv"] < state_data[f"{key}_lv"] and state_data[f"{key}_lv"] - latest[f"{key}_lv"] < 10:
+            return True
+    if latest["influence"] < state_data["influence"] and state_data["influence"] - latest["influence"] < 10:
+        return True
+    if latest["activity"] != state_data["activity"] and abs(state_data["activity"] - latest["activity"]) < 100:
+        return True
+    return False
+
+
+class StateStore:
+    """state_data 的讀寫介面。
+
+    每個國家的最新一筆保存在記憶體中 (寫入時同步更新)，變化判斷只在快取未命中時才讀取資料庫。
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.conn = connect(path)
+        self._latest = {} # {國家: 最新一筆的欄位字典}
+        self.load_latest()
+
+    def load_latest(self):
+        """從資料庫載入每個國家的最新一筆到記憶體，返回載入的國家數。"""
+        self._latest = {}
+        for (state,) in self.conn.execute(_STATES_SQL).fetchall():
+            row = self.conn.execute(_LATEST_SQL, (state,)).fetchone()
+            self._latest[state] = {column: row[column] for column in STATE_COLUMNS}
+        return len(self._latest)
+
+    def latest(self, state):
+        """返回某國家的最新一筆 (欄位字典) 或 None，優先使用記憶體中的資料。"""
+        cached = self._latest.get(state)
+        if cached is not None:
+            return cached
+        row = self.conn.execute(_LATEST_SQL, (state,)).fetchone()
+        if row is None:
+            return None
+        cached = self._latest[state] = {column: row[column] for column in STATE_COLUMNS}
+        return cached
+
+    def insert_many(self, readings):
+        """在單一交易中寫入多筆讀數並更新記憶體中的最新一筆，返回寫入的筆數。"""
+        rows = [tuple(state_data[column] for column in STATE_COLUMNS) for state_data in readings]
+        if not rows:
+            return 0
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(_INSERT_SQL, rows)
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        # 交易成功後才更新快取，寫入失敗時快取仍與資料庫一致
+        for row in rows:
+            self._latest[row[0]] = dict(zip(STATE_COLUMNS, row))
+        return len(rows)
+
+    def record_tick(self, readings):
+        """處理一次排程的所有讀數：沒有資料或有增長的國家才寫入，全部在一個交易中完成。
+
+        沒有變化的國家只在記憶體中比較，不會存取資料庫。
+
+        返回:
+            list: 實際寫入的讀數
+        """
+        with span("db.record_tick", readings=len(readings)) as tick_span:
+            changed = []
+            for state_data in readings:
+                latest = self.latest(state_data["state"])
+                if latest is None:
+                    changed.append(state_data)
+                elif has_grown(latest, state_data):
+                    print(f"{state_data['state']} 有增長")
+                    changed.append(state_data)
+            self.insert_many(changed)
+            tick_span.set(inserted=len(changed))
+        return changed
+
+    def states(self):
+        return read_states(self.conn)
+
+    def latest_rows(self):
+        return read_latest_rows(self.conn)
+
+    def value_at(self, state, at):
+        return read_value_at(self.conn, state, at)
+
+    def rollup(self, batch_size=ROLLUP_BATCH_SIZE):
+        """將上次彙整之後新增的原始資料累加到每小時與每日的彙總表，返回處理的筆數。
+
+        只讀取 id 大於進度表記錄的資料，每批在一個交易中更新彙總表與進度，
+        因此中斷後重新執行不會重複計算。
+        """
+        processed = 0
+        while True:
+            row = self.conn.execute("SELECT last_id FROM rollup_progress WHERE name = 'state_data'").fetchone()
+            last_id = row[0] if row else 0
+            rows = self.conn.execute(
+                f"SELECT id, updated_at, {', '.join(STATE_COLUMNS)} FROM state_data WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size),
+            ).fetchall()
+            if not rows:
+                return processed
+            self.conn.execute("BEGIN")
+            try:
+                for name, (_, prefix_length, suffix) in ROLLUPS.items():
+                    buckets = _aggregate(rows, prefix_length, suffix)
+                    self.conn.executemany(_ROLLUP_UPSERT_SQL[name], buckets)
+                self.conn.execute(
+                    "INSERT INTO rollup_progress (name, last_id) VALUES ('state_data', ?) "
+                    "ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id",
+                    (rows[-1]["id"],),
+                )
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            processed += len(rows)
+
+    def prune(self, retention_hours=RAW_RETENTION_HOURS, batch_size=PRUNE_BATCH_SIZE):
+        """刪除超過保留時數且已彙整的原始資料，每個國家的最新一筆一律保留，返回刪除的筆數。
+
+        較舊的資料已經刪除，每次只會掃描保留期間內的資料與新過期的資料，不會掃描整個歷史。
+        """
+        row = self.conn.execute("SELECT last_id FROM rollup_progress WHERE name = 'state_data'").fetchone()
+        if row is None:
+            return 0
+        rolled_up_id = row[0]
+        keep_ids = [self.conn.execute(_LATEST_SQL, (state,)).fetchone()["id"]
+                    for (state,) in self.conn.execute(_STATES_SQL).fetchall()]
+        keep_placeholders = ", ".join("?" for _ in keep_ids) or "NULL"
+        deleted = 0
+        while True:
+            self.conn.execute("BEGIN")
+            try:
+                cursor = self.conn.execute(f"""
+                    DELETE FROM state_data WHERE id IN (
+                        SELECT id FROM state_data
+                        WHERE id <= ?
+                          AND updated_at < datetime('now', ?)
+                          AND id NOT IN ({keep_placeholders})
+                        ORDER BY id
+                        LIMIT ?
+                    )
+                """, (rolled_up_id, f"-{retention_hours} hours", *keep_ids, batch_size))
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return deleted
+
+    def compact(self, retention_hours=RAW_RETENTION_HOURS):
+        """彙整新資料後刪除過期的原始資料，返回 (彙整筆數, 刪除筆數)。"""
+        with span("db.compact") as compact_span:
+            rolled_up = self.rollup()
+            pruned = self.prune(retention_hours)
+            compact_span.set(rolled_up=rolled_up, pruned=pruned)
+        if rolled_up or pruned:
+            print(f"資料庫整理: 彙整 {rolled_up} 筆，刪除 {pruned} 筆過期的原始資料")
+        return rolled_up, pruned
+
+    def history(self, state, since, until=None, resolution=None, retention_hours=RAW_RETENTION_HOURS):
+        """讀取某國家在 [since, until] 之間的資料，since/until 為 UTC 'YYYY-MM-DD HH:MM:SS'。
+
+        resolution 為 None 時自動選擇: 仍在原始資料保留期間內用 'raw'，兩週內用 'hourly'，更長用 'daily'。
+        原始資料返回 STATE_COLUMNS 與 updated_at；彙總資料返回彙總表的欄位。
+        """
+        until = until or "9999-12-31 23:59:59"
+        if resolution is None:
+            raw_since, hourly_since = self.conn.execute(
+                "SELECT datetime('now', ?), datetime('now', '-14 days')", (f"-{retention_hours} hours",)
+            ).fetchone()
+            resolution = "raw" if since >= raw_since else "hourly" if since >= hourly_since else "daily"
+        if resolution == "raw":
+            return self.conn.execute(f"""
+                SELECT {', '.join(STATE_COLUMNS)}, updated_at FROM state_data
+                WHERE state = ? AND updated_at BETWEEN ? AND ?
+                ORDER BY updated_at, id
+            """, (state, since, until)).fetchall()
+        table, prefix_length, suffix = ROLLUPS[resolution]
+        return self.conn.execute(f"""
+            SELECT * FROM {table}
+            WHERE state = ? AND bucket BETWEEN ? AND ?
+            ORDER BY bucket
+        """, (state, since[:prefix_length] + suffix, until)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def _aggregate(rows, prefix_length, suffix):
+    """將依 id 排序的原始資料依 (國家, 時間區間) 彙總為 upsert 參數列表。"""
+    buckets = {}
+    for row in rows:
+        key = (row["state"], row["updated_at"][:prefix_length] + suffix)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = {"samples": 0, "last_at": None}
+            for column in VALUE_COLUMNS:
+                bucket[column] = [None, None, None]
+        bucket["samples"] += 1
+        bucket["last_at"] = row["updated_at"]
+        for column in VALUE_COLUMNS:
+            value = row[column]
+            if value is None:
+                continue
+            stats = bucket[column]
+            stats[0] = value if stats[0] is None else min(stats[0], value)
+            stats[1] = value if stats[1] is None else max(stats[1], value)
+            stats[2] = value # 依 id 排序，最後一筆就是最新值
+    params = []
+    for (state, bucket_start), bucket in buckets.items():
+        values = [state, bucket_start, bucket["samples"], bucket["last_at"]]
+        for column in VALUE_COLUMNS:
+            values.extend(bucket[column])
+        params.append(values)
+    return params
@@ -2,117 +2,35 @@ import asyncio
 import datetime
 import os
 import random
-import sqlite3
-import warnings
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import cv2
 import discord
-import easyocr
-import numpy as np
-import pytesseract
-import requests
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
 
-reader = easyocr.Reader(['en'])
-
-# 忽略特定內容的 warning（pin_memory on MPS）
-warnings.filterwarnings("ignore", message="'pin_memory' argument is set as true but not supported on MPS")
-
+from imageDownloader import download_image_bytes
+from ocrReader import warm_up_reader
+from ocrWorkerPool import OcrWorkerPool
+from runMetrics import finish_run, span, start_run
+from selfBotExecutor import HistoryPages, report_missing_states
+from stateStatusExtractor import OCR_USE_GPU, get_state_status
+from stateStore import DB_PATH, StateStore
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
-CHANNEL_ID = int(os.getenv("DISCORD_CHANNEL_ID"))
-
-# 連接資料庫（如果檔案不存在會自動建立）
-conn = sqlite3.connect("my_database.db")
-
-conn.row_factory = sqlite3.Row
-
-# 建立 cursor 物件
-cursor = conn.cursor()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS state_data (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    state TEXT,
-    activity INTEGER,
-    military INTEGER,
-    trade INTEGER,
-    tech INTEGER,
-    culture INTEGER,
-    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-
-def insert_state_data(state_data: dict):
-    cursor.execute("""
-        INSERT INTO state_data (state, activity, influence, military, military_lv, trade, trade_lv, tech, tech_lv, culture, culture_lv)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-        state_data["state"], state_data["activity"], state_data["influence"],
-        state_data["military"], state_data["military_lv"],
-        state_data["trade"], state_data["trade_lv"],
-        state_data["tech"], state_data["tech_lv"],
-        state_data["culture"], state_data["culture_lv"]
-    ))
-    conn.commit()
-
-
-def check_and_insert_state_data(state_data: dict):
-    # 撈出最新一筆
-    cursor.execute("""
-        SELECT * 
-        FROM state_data 
-        WHERE state = ?
-        ORDER BY updated_at DESC
-        LIMIT 1
-    """, (state_data["state"],))
-    latest_data = cursor.fetchone()
-
-    # 如果沒有資料，就新增
-    if not latest_data:
-        cursor.execute("""
-        INSERT INTO state_data (state, activity, influence, military, military_lv, trade, trade_lv, tech, tech_lv, culture, culture_lv)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            state_data["state"], state_data["activity"], state_data["influence"],
-            state_data["military"], state_data["military_lv"],
-            state_data["trade"], state_data["trade_lv"],
-            state_data["tech"], state_data["tech_lv"],
-            state_data["culture"], state_data["culture_lv"]
-        ))
-        conn.commit()
-        return
-
-    # 檢查各項數值是不是有增長
-    # 如果軍事、貿易、科技、文化或等級其中一項有增長，就更新
-    need_update = False
-    for key in ["military", "trade", "tech", "culture"]:
-        if latest_data[key] < state_data[key] and state_data[key] - latest_data[key] < 1000:
-            need_update = True
-            break
-        elif latest_data[f"{key}_lv"] < state_data[f"{key}_lv"] and state_data[f"{key}_lv"] - latest_data[f"{key}_lv"] < 10:
-            need_update = True
-            break
-    if latest_data["influence"] < state_data["influence"] and state_data["influence"] - latest_data["influence"] < 10:
-        need_update = True
-    if latest_data["activity"] != state_data["activity"] and abs(state_data["activity"] - latest_data["activity"]) < 100:
-        need_update = True
-    if need_update:
-        print(f"{state_data['state']} 有增長")
-        cursor.execute("""
-        INSERT INTO state_data (state, activity, influence, military, military_lv, trade, trade_lv, tech, tech_lv, culture, culture_lv)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            state_data["state"], state_data["activity"], state_data["influence"],
-            state_data["military"], state_data["military_lv"],
-            state_data["trade"], state_data["trade_lv"],
-            state_data["tech"], state_data["tech_lv"],
-            state_data["culture"], state_data["culture_lv"]
-        ))
-        conn.commit()
+# 設為 1 時以常駐的多行程池平行辨識各國家
+OCR_PARALLEL = os.getenv("OCR_PARALLEL") == "1"
+
+# 同時下載圖片的執行緒數
+BOT_IO_WORKERS = int(os.getenv("BOT_IO_WORKERS", "8"))
+# event: 由新訊息 (與編輯) 觸發處理，並以低頻率重新讀取頻道對帳；poll: 每三分鐘重新讀取最近的訊息
+BOT_INGEST_MODE = os.getenv("BOT_INGEST_MODE", "event")
+INGEST_DEBOUNCE_SECONDS = float(os.getenv("INGEST_DEBOUNCE_SECONDS", "5")) # 最後一張新圖片之後等待多久才處理
+INGEST_MAX_DELAY_SECONDS = float(os.getenv("INGEST_MAX_DELAY_SECONDS", "30")) # 第一張新圖片之後最多等待多久
+RECONCILE_MINUTES = int(os.getenv("RECONCILE_MINUTES", "30")) # event 模式下對帳的間隔
+# 設為 1 時每次讀取都附加一份執行報告到 runMetrics.RUN_REPORT_FILE (常駐程式預設不寫)
+BOT_RUN_REPORT = os.getenv("BOT_RUN_REPORT") == "1"
 
 
 state_name = {
@@ -128,107 +46,196 @@ state_name = {
 
 
 class MyClient(discord.Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 頻道、資料庫與執行緒池在建立客戶端時才設定：OCR 工作行程 (spawn) 會重新匯入此模組，
+        # 不應在每個工作行程中開啟資料庫或建立執行緒池
+        self.channel_id = int(os.getenv("DISCORD_CHANNEL_ID"))
+        # 連接資料庫（如果檔案不存在會自動建立，並套用尚未執行的結構遷移）
+        self.store = StateStore(DB_PATH)
+        # 阻塞的工作交給專用的執行緒，事件迴圈只處理 Discord 連線 (心跳) 與排程
+        self.io_executor = ThreadPoolExecutor(max_workers=BOT_IO_WORKERS, thread_name_prefix="bot-io") # 下載圖片、等待工作行程池
+        self.ocr_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot-ocr") # 單一執行緒使用共用的 EasyOCR Reader
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot-db") # SQLite 連線一次只在一個執行緒上使用
+        self.ocr_pool = None
+        self.scheduler = None
+        self._tick_running = False # 是否有讀取正在執行
+        self._full_scan_pending = False # 需要重新讀取頻道歷史訊息 (排程或對帳)
+        self._pending_urls = {} # 由新訊息收到、尚未處理的 {國家: 圖片 URL}
+        self._first_pending_at = None # 第一張待處理圖片到達的時間 (loop.time())
+        self._ingest_handle = None # 防抖動計時器
+        self._ingest_task = None
+
     async def on_ready(self):
         print('Logged on as', self.user)
-        await self.read_state_status()
-        scheduler = AsyncIOScheduler()
-        # 十分鐘爬一次
-        scheduler.add_job(self.read_state_status, 'cron', minute='*/3')
+        if self.scheduler:
+            return # 重新連線時也會觸發 on_ready，排程與工作行程池只建立一次
+        if OCR_PARALLEL:
+            # 工作行程在啟動時各自載入 Reader，之後每次排程都重複使用
+            self.ocr_pool = OcrWorkerPool(gpu=OCR_USE_GPU)
+            await asyncio.get_running_loop().run_in_executor(self.io_executor, self.ocr_pool.warm_up)
+        else:
+            # 在背景載入 OCR 模型，與讀取頻道歷史訊息同時進行
+            warm_up_reader(OCR_USE_GPU)
+        scheduler = self.scheduler = AsyncIOScheduler()
+        if BOT_INGEST_MODE == "poll":
+            # 每三分鐘重新讀取最近的訊息
+            scheduler.add_job(self.read_state_status, 'cron', minute='*/3')
+        else:
+            # 新圖片由 on_message 即時處理，低頻率的對帳只用來補上漏接的訊息 (例如斷線期間)
+            scheduler.add_job(self.read_state_status, 'interval', minutes=RECONCILE_MINUTES)
+        # 每小時將新資料彙整到彙總表，並刪除超過保留期間的原始資料
+        scheduler.add_job(self.compact_history, 'cron', minute=7)
         scheduler.start()
+        await self.read_state_status()
         await asyncio.Event().wait()  # 保持事件迴圈運行
 
+    async def on_message(self, message):
+        if BOT_INGEST_MODE == "poll":
+            return
+        self._queue_state_images(message)
+
+    async def on_message_edit(self, before, after):
+        if BOT_INGEST_MODE == "poll":
+            return
+        # 只有附件改變的編輯才需要重新辨識
+        if [a.url for a in before.attachments] != [a.url for a in after.attachments]:
+            self._queue_state_images(after)
+
+    def _queue_state_images(self, message):
+        """記錄目標頻道新訊息中的國家圖片，並 (重新) 啟動防抖動計時器。"""
+        if message.channel.id != self.channel_id or not message.attachments:
+            return
+        url = message.attachments[0].url
+        state = state_name.get(url.split("/")[-1].split("?")[0])
+        if not state:
+            return
+        self._pending_urls[state] = url # 同一國家在處理前又更新時只保留最新的一張
+        loop = asyncio.get_running_loop()
+        if self._first_pending_at is None:
+            self._first_pending_at = loop.time()
+        # 八個國家通常一起發佈：每張新圖片都把處理延後 INGEST_DEBOUNCE_SECONDS，
+        # 但從第一張起最多等待 INGEST_MAX_DELAY_SECONDS
+        delay = min(INGEST_DEBOUNCE_SECONDS, max(0.0, self._first_pending_at + INGEST_MAX_DELAY_SECONDS - loop.time()))
+        if self._ingest_handle:
+            self._ingest_handle.cancel()
+        self._ingest_handle = loop.call_later(delay, self._start_ingest)
+
+    def _start_ingest(self):
+        self._ingest_handle = None
+        self._first_pending_at = None
+        self._ingest_task = asyncio.ensure_future(self._run_ticks())
+
+    async def compact_history(self):
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.db_executor, self.store.compact)
+        except Exception as e:
+            print(f"整理資料庫時發生錯誤: {e}")
+
     async def read_state_status(self):
-        print(f"---- 讀取國家狀態, {datetime.datetime.now()} ----")
-        channel = self.get_channel(CHANNEL_ID)  # 將 CHANNEL_ID 替換為目標頻道的 ID
-        state_list = []
-        async for message in channel.history(limit=10):
-            # 讀取訊息裡的圖片
+        """排程 (或對帳) 進入點：重新讀取頻道最近的訊息並處理所有國家。"""
+        if self._tick_running and not self._full_scan_pending:
+            print("上一次讀取國家狀態尚未完成，完成後再執行一次")
+        self._full_scan_pending = True
+        await self._run_ticks()
+
+    async def _run_ticks(self):
+        """依序處理待辦的讀取；已有讀取在執行時直接返回，由它在結束後接著處理 (不重疊，多次觸發合併)。"""
+        if self._tick_running:
+            return
+        self._tick_running = True
+        try:
+            while self._full_scan_pending or self._pending_urls:
+                full_scan, self._full_scan_pending = self._full_scan_pending, False
+                urls, self._pending_urls = self._pending_urls, {}
+                if BOT_RUN_REPORT:
+                    # 每次讀取各自產生一份執行報告 (runMetrics.RUN_REPORT_FILE)
+                    start_run("bot_tick" if full_scan else "bot_ingest")
+                started = time.perf_counter()
+                try:
+                    if full_scan:
+                        print(f"---- 讀取國家狀態, {datetime.datetime.now()} ----")
+                        try:
+                            # 新訊息事件收到的圖片不會比歷史訊息中的舊
+                            urls = {**await self._latest_urls_from_history(), **urls}
+                        except Exception as e:
+                            # 例如重新連線期間找不到頻道；已由新訊息收到的圖片仍照常處理，不會遺失
+                            print(f"讀取頻道歷史訊息時發生錯誤: {e}")
+                    else:
+                        print(f"---- 處理新圖片: {', '.join(urls)}, {datetime.datetime.now()} ----")
+                    await self._process_state_images(urls)
+                except Exception as e:
+                    print(f"讀取國家狀態時發生錯誤: {e}")
+                finally:
+                    if BOT_RUN_REPORT:
+                        # 寫檔在 I/O 執行緒中進行，不阻塞事件迴圈
+                        await asyncio.get_running_loop().run_in_executor(self.io_executor, finish_run)
+                print(f"---- 讀取國家狀態完成，耗時 {time.perf_counter() - started:.2f} 秒 ----")
+        finally:
+            self._tick_running = False
+
+    async def _latest_urls_from_history(self):
+        """從頻道的歷史訊息中找出每個國家最新的圖片 URL。
+
+        與 selfBotExecutor 的掃描相同，以 HistoryPages 由新到舊逐頁讀取，所有國家都找到時提早停止；
+        斷線期間發佈了超過一頁的訊息時也不會漏掉國家。
+        """
+        channel = self.get_channel(self.channel_id) or await self.fetch_channel(self.channel_id)
+        urls = {}
+        async for _, message in HistoryPages(channel):
+            # 讀取訊息裡的圖片 (由新到舊，每個國家只取最新的一張)
             if message.attachments:
                 url = message.attachments[0].url
-                state = state_name[url.split("/")[-1].split("?")[0]]
-                download_image(url)
-                state_list.append(state)
-        print(f"抓取 {len(state_list)} 張圖片完畢\n-----------")
-        for state in state_list:
+                state = state_name.get(url.split("/")[-1].split("?")[0])
+                if state and state not in urls:
+                    urls[state] = url
+                    if len(urls) == len(state_name):
+                        return urls
+        report_missing_states([state for state in state_name.values() if state not in urls])
+        return urls
+
+    async def _process_state_images(self, urls):
+        """下載、辨識並記錄 {國家: 圖片 URL} 中的國家狀態 (圖片只保留在記憶體中)。"""
+        loop = asyncio.get_running_loop()
+        # 所有圖片同時在 I/O 執行緒中下載
+        downloads = await asyncio.gather(
+            *(loop.run_in_executor(self.io_executor, download_image_bytes, url) for url in urls.values()),
+            return_exceptions=True)
+        images = {}
+        for state, result in zip(urls, downloads):
+            if isinstance(result, Exception):
+                print(f"下載 {state} 的圖片時發生錯誤: {result}")
+            else:
+                images[state] = result
+        print(f"抓取 {len(images)} 張圖片完畢\n-----------")
+        pool_results = {}
+        if self.ocr_pool:
+            # 所有國家交給工作行程平行辨識，之後依國家順序處理結果
+            with span("ocr.pool", states=len(images)):
+                pool_results = await loop.run_in_executor(self.io_executor, self.ocr_pool.get_state_statuses, images)
+        readings = []
+        for state, content in images.items():
             try:
-                state_data = get_state_status(state)
+                if self.ocr_pool:
+                    state_data = pool_results[state]
+                    if state_data is None:
+                        continue # 錯誤已由工作行程池記錄
+                else:
+                    # 在 OCR 執行緒中辨識，事件迴圈在等待期間仍可處理心跳
+                    state_data = await loop.run_in_executor(self.ocr_executor, get_state_status, state, content)
                 print(f"{state}(影響力: {state_data['influence']}): 活動值: {state_data['activity']}, 軍事值: {state_data['military']}(lv:{state_data['military_lv']}), 貿易值: {state_data['trade']}(lv:{state_data['trade_lv']}), 科技值: {state_data['tech']}(lv:{state_data['tech_lv']}), 文化值: {state_data['culture']}(lv:{state_data['culture_lv']})")
-                check_and_insert_state_data(state_data)
+                readings.append(state_data)
             except Exception as e:
                 print(f"讀取國家狀態時發生錯誤: {e}")
             print("----")
+        # 所有國家的比較與寫入在同一個交易中完成
+        try:
+            changed = await loop.run_in_executor(self.db_executor, self.store.record_tick, readings)
+            print(f"寫入 {len(changed)} 筆國家狀態")
+        except Exception as e:
+            print(f"寫入資料庫時發生錯誤: {e}")
 
 
-def download_image(url: str):
-    state = state_name[url.split("/")[-1].split("?")[0]]
-    response = requests.get(url)
-    with open(f"./state_images/{state}.png", "wb") as f:
-        f.write(response.content)
-
-
-def extract_number_from_region(img, x, y, dx, dy):
-    # 擷取 ROI 區域
-    roi = img[y:y+dy, x:x+dx]
-
-    # 放大 3 倍
-    large_img = cv2.resize(roi, dsize=(0, 0), fx=3, fy=3)
-
-    # # 二值化
-    # _, thresh = cv2.threshold(large_img, 150, 255, cv2.THRESH_BINARY)
-
-    # # 先腐蝕再膨脹（幫助字元分離）
-    # kernel = np.ones((2, 2), np.uint8)
-    # processed = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-
-    # # OCR 辨識（只允許數字、使用單行模式）
-    # config = '--psm 7 -c tessedit_char_whitelist=0123456789'
-    # text = pytesseract.image_to_string(processed, config=config).strip()
-
-    # 使用 EasyOCR 辨識
-    result = reader.readtext(large_img, detail=0)
-    return result[0]
-
-
-def get_state_status(state: str):
-    path = f"./state_images/{state}.png"
-    img = cv2.imread(path)
-    for j in range(0, 450):
-        for i in range(0, 800):
-            if img[j, i][0] >= 150 or img[j, i][1] >= 150 or img[j, i][2] >= 150:
-                img[j, i][0] = 255
-                img[j, i][1] = 255
-                img[j, i][2] = 255
-            else:
-                img[j, i][0] = 0
-                img[j, i][1] = 0
-                img[j, i][2] = 0
-    cv2.imwrite(f"./state_images/_{state}_gray.png", img)
-    # 讀取圖片
-    activity = extract_number_from_region(img, 483, 100, 107, 36)
-    military = extract_number_from_region(img, 485, 161, 106, 46)
-    military_lv = extract_number_from_region(img, 685, 161, 48, 46)
-    trade = extract_number_from_region(img, 485, 224, 106, 46)
-    trade_lv = extract_number_from_region(img, 685, 224, 48, 46)
-    tech = extract_number_from_region(img, 485, 287, 106, 46)
-    tech_lv = extract_number_from_region(img, 685, 287, 48, 46)
-    culture = extract_number_from_region(img, 485, 349, 106, 46)
-    culture_lv = extract_number_from_region(img, 685, 349, 48, 46)
-    influence = extract_number_from_region(img, 85, 288, 52, 50)
-
-    return {
-        "state": state,
-        "activity": int(activity),
-        "influence": int(influence),
-        "military": int(military),
-        "military_lv": int(military_lv),
-        "trade": int(trade),
-        "trade_lv": int(trade_lv),
-        "tech": int(tech),
-        "tech_lv": int(tech_lv),
-        "culture": int(culture),
-        "culture_lv": int(culture_lv)
-    }
-
-
-client = MyClient()
-client.run(TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    client = MyClient()
+    client.run(TOKEN)